@@ -1,6 +1,8 @@
 import architecture.resnet
 import architecture.smi13
 import architecture.vgg16
+import cluster.bovw
+import cluster.descriptorindex
 import cluster.histogram
 import cluster.hybridcluster
 import cluster.sift
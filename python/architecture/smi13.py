@@ -17,6 +17,7 @@ class Smi13(Architecture):
 
     NAME = 'smi13'
     OUTPUT_TYPE: OutputType = OutputType.SCALAR
+    BATCH_SIZE = 32
 
     def create(self, res: Resolution, classes: Optional[int]) -> Model:
         """
@@ -6,6 +6,9 @@ import aaa
 import addon
 import core.modelbuilder
 import core.model
+from core.fingerprint import ALGORITHMS, use_algorithm
+from core.kerashelper import DataLoader
+from core.tfdata import TfDataLoader
 
 
 def doSomething(
@@ -20,7 +23,9 @@ def doSomething(
         summary=False,
         train=False,
         evaluate=False,
-        remove_bad=False
+        remove_bad=False,
+        loader=None,
+        tune=0,
 ):
     try:
         model = core.modelbuilder.ModelBuilder.create(
@@ -31,6 +36,7 @@ def doSomething(
             metrics,
             epochs,
             patience,
+            loader,
         )
         print()
         print()
@@ -39,6 +45,8 @@ def doSomething(
         else:
             if split != None:
                 model = model.split(split)
+            if tune > 0:
+                model.tune(tune * 2 ** 20)
             if train and evaluate and remove_bad:
                 model.auto_train()
             else:
@@ -89,7 +97,18 @@ def main():
     parser.add_argument('--train', action='store_true')
     parser.add_argument('--evaluate', action='store_true')
     parser.add_argument('--removebad', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='threads or processes that make batches')
+    parser.add_argument('--multiprocessing', action='store_true', help='make batches in processes instead of threads')
+    parser.add_argument('--queue', type=int, default=10, help='batches made ahead of the model')
+    parser.add_argument('--tfdata', action='store_true', help='make batches with a tf.data pipeline instead')
+    parser.add_argument('--tune', type=int, default=0, help='choose the batch size within this many MiB before training')
+    parser.add_argument('--fingerprint', choices=ALGORITHMS, default='md5', help='hash of the image contents that keys the caches')
     args = parser.parse_args()
+    use_algorithm(args.fingerprint)
+    if args.tfdata:
+        loader = TfDataLoader()
+    else:
+        loader = DataLoader(args.workers, args.multiprocessing, args.queue)
     if args.options:
         print()
         print('Architectures')
@@ -124,6 +143,8 @@ def main():
                     args.train,
                     args.evaluate,
                     args.removebad,
+                    loader,
+                    args.tune,
                 )
         except FileNotFoundError:
             print("MISSING: %s" % args.model)
@@ -142,6 +163,8 @@ def main():
                 train=args.train,
                 evaluate=args.evaluate,
                 remove_bad=args.removebad,
+                loader=loader,
+                tune=args.tune,
             )
 
 
@@ -0,0 +1,236 @@
+from typing import Iterable, Optional
+
+from numpy import (add, append, arange, argpartition, bincount, concatenate,
+                   diff, finfo, float32, float64, full, inf, isfinite, lexsort,
+                   maximum, minimum, ndarray, repeat, searchsorted, sort,
+                   take_along_axis, unique, where, zeros)
+from numpy.random import RandomState
+from scipy.sparse import coo_matrix, csr_matrix
+
+
+def top_k_rows(blocks: Iterable[ndarray], n: int, k: int) -> csr_matrix:
+    """
+    Returns a sparse float32 matrix that keeps the k most similar entries of each row of an n by n similarity matrix.
+    The matrix is given as consecutive blocks of rows, so it never has to be held whole.
+    The SIFT similarities are exactly zero for pairs without a good match and can be negative for pairs with them.
+    So zero entries and the diagonal are dropped, and the rest are ranked by value whatever their sign.
+    """
+    k = min(k, n - 1)
+    if k <= 0:
+        return csr_matrix((n, n), dtype=float32)
+    rows = [zeros(0, int)]
+    cols = [zeros(0, int)]
+    data = [zeros(0, float32)]
+    start = 0
+    for block in blocks:
+        b = block.astype(float32)
+        r = arange(start, start + len(b))
+        b[b == 0] = -inf
+        b[r - start, r] = -inf
+        c = argpartition(-b, k - 1, axis=1)[:, :k]
+        v = take_along_axis(b, c, axis=1)
+        keep = isfinite(v)
+        rows.append(repeat(r, k)[keep.ravel()])
+        cols.append(c[keep])
+        data.append(v[keep])
+        start += len(b)
+    return coo_matrix(
+        (concatenate(data), (concatenate(rows), concatenate(cols))),
+        shape=(n, n),
+    ).tocsr()
+
+
+def top_k(matrix: ndarray, k: int, block: int = 1024) -> csr_matrix:
+    """
+    Returns a sparse float32 copy of a similarity matrix that keeps the k most similar entries of each row.
+    Rows are converted in blocks, so only one block is held at float32 besides the result.
+    """
+    n = matrix.shape[0]
+    return top_k_rows((matrix[start:start + block] for start in range(0, n, block)), n, k)
+
+
+def implicit_median(data: ndarray, size: int) -> float:
+    """
+    Returns the median of the stored values of a sparse matrix with the rest of its size entries as zeros, without making the zeros.
+    """
+    if size == 0:
+        return 0.0
+    values = sort(data)
+    below = searchsorted(values, 0)
+    missing = size - len(values)
+
+    def at(p: int) -> float:
+        if p < below:
+            return float(values[p])
+        elif p < below + missing:
+            return 0.0
+        return float(values[p - missing])
+
+    return (at((size - 1) // 2) + at(size // 2)) / 2
+
+
+class SparseAffinityPropagation(object):
+    """
+    Affinity propagation that only passes messages along the stored entries of a sparse similarity matrix.
+    Missing entries are treated as infinitely dissimilar, so time and memory grow with the number of edges instead of n squared.
+    The message updates and the final refinement of exemplars are the same as sklearn.cluster.AffinityPropagation.
+    """
+
+    def __init__(
+        self,
+        damping: float = 0.5,
+        max_iter: int = 200,
+        convergence_iter: int = 15,
+        preference: Optional[float] = None,
+        random_state: int = 0,
+    ) -> None:
+        self.damping = damping
+        self.max_iter = max_iter
+        self.convergence_iter = convergence_iter
+        self.preference = preference
+        self.random_state = random_state
+
+    def _with_preference(self, similarity: csr_matrix) -> csr_matrix:
+        """
+        Returns the similarity matrix with its diagonal replaced by the preference.
+        The default preference is the median of the full matrix with missing entries as zeros, which is what the dense matrix would give.
+        The edges kept are the most similar neighbors of each point, so the median of the edges alone is much higher and splits images into too many clusters.
+        """
+        s = coo_matrix(similarity)
+        off = s.row != s.col
+        data = s.data[off].astype(float64)
+        n = similarity.shape[0]
+        preference = self.preference
+        if preference is None:
+            preference = implicit_median(data, n * n)
+        s = coo_matrix(
+            (
+                append(data, full(n, preference)),
+                (append(s.row[off], arange(n)), append(s.col[off], arange(n))),
+            ),
+            shape=(n, n),
+        ).tocsr()
+        s.sort_indices()
+        return s
+
+    def _remove_degeneracies(self, s: csr_matrix) -> csr_matrix:
+        """
+        Returns a copy of the similarity matrix with a little noise added like sklearn does, so ties are broken.
+        """
+        s = s.copy()
+        random_state = RandomState(self.random_state)
+        s.data = s.data + (finfo(float64).eps * s.data + finfo(float64).tiny * 100) * random_state.standard_normal(len(s.data))
+        return s
+
+    def _exemplars(self, s: csr_matrix) -> ndarray:
+        """
+        Passes messages between points and returns a boolean array that marks the exemplars.
+        Every row must have at least one entry besides the diagonal.
+        """
+        n = s.shape[0]
+        starts = s.indptr[:-1]
+        lengths = diff(s.indptr)
+        rows = repeat(arange(n), lengths)
+        cols = s.indices
+        diagonal = rows == cols
+        similarity = s.data
+        responsibility = zeros(len(similarity))
+        availability = zeros(len(similarity))
+        exemplars = zeros(n, bool)
+        history = zeros((n, self.convergence_iter), bool)
+        for it in range(self.max_iter):
+            # Responsibilities
+            tmp = availability + similarity
+            max1 = maximum.reduceat(tmp, starts)
+            is_max = tmp == repeat(max1, lengths)
+            ties = add.reduceat(is_max.astype(int), starts)
+            max2 = maximum.reduceat(where(is_max, -inf, tmp), starts)
+            max2 = where(ties >= 2, max1, max2)
+            new = similarity - where(is_max, repeat(max2, lengths), repeat(max1, lengths))
+            responsibility = self.damping * responsibility + (1 - self.damping) * new
+            # Availabilities
+            positive = where(diagonal, responsibility, maximum(responsibility, 0))
+            new = bincount(cols, weights=positive, minlength=n)[cols] - positive
+            new = where(diagonal, new, minimum(new, 0))
+            availability = self.damping * availability + (1 - self.damping) * new
+            # Convergence
+            exemplars = zeros(n, bool)
+            exemplars[rows[diagonal]] = (availability + responsibility)[diagonal] > 0
+            history[:, it % self.convergence_iter] = exemplars
+            if it >= self.convergence_iter:
+                count = history.sum(axis=1)
+                if exemplars.any() and ((count == 0) | (count == self.convergence_iter)).all():
+                    break
+        return exemplars
+
+    @staticmethod
+    def _assign(s: csr_matrix, exemplars: ndarray) -> ndarray:
+        """
+        Returns the most similar exemplar that each point has an edge to, or -1 if it has none.
+        Exemplars belong to themselves.
+        """
+        c = coo_matrix(s)
+        edges = exemplars[c.col]
+        row, col, data = c.row[edges], c.col[edges], c.data[edges]
+        order = lexsort((data, row))
+        row, col = row[order], col[order]
+        last = append(row[1:] != row[:-1], True) if len(row) > 0 else zeros(0, bool)
+        best = full(s.shape[0], -1)
+        best[row[last]] = col[last]
+        best[exemplars] = where(exemplars)[0]
+        return best
+
+    @staticmethod
+    def _refine(s: csr_matrix, best: ndarray) -> ndarray:
+        """
+        Returns the exemplars after moving each one to the member of its cluster with the largest sum of similarities from the members, like sklearn does.
+        A missing entry is infinitely dissimilar, so only members with an edge from every member can become the exemplar.
+        The old exemplar always qualifies, since every member joined it by an edge.
+        """
+        n = s.shape[0]
+        c = coo_matrix(s)
+        same = (best[c.row] >= 0) & (best[c.row] == best[c.col])
+        col, data = c.col[same], c.data[same]
+        total = bincount(col, weights=data, minlength=n)
+        count = bincount(col, minlength=n)
+        size = bincount(best[best >= 0], minlength=n)
+        members = where(best >= 0)[0]
+        complete = count[members] == size[best[members]]
+        score = where(complete, total[members], -inf)
+        # The last member of each cluster has the largest score, and the lowest index among ties like argmax.
+        order = lexsort((-members, score, best[members]))
+        cluster = best[members][order]
+        last = append(cluster[1:] != cluster[:-1], True) if len(order) > 0 else zeros(0, bool)
+        exemplars = zeros(n, bool)
+        exemplars[members[order][last]] = True
+        return exemplars
+
+    def fit_predict(self, similarity: csr_matrix) -> ndarray:
+        """
+        Returns a cluster label for each row of a sparse similarity matrix.
+        Points without an edge to an exemplar become clusters of their own.
+        """
+        n = similarity.shape[0]
+        sub = self._with_preference(csr_matrix(similarity))
+        # Dropping points without edges can leave others without edges, so points are dropped until none are left alone.
+        connected = arange(n)
+        while len(connected) > 0:
+            keep = diff(sub.indptr) > 1
+            if keep.all():
+                break
+            connected = connected[keep]
+            sub = sub[keep][:, keep].tocsr()
+        labels = full(n, -1)
+        if len(connected) > 0:
+            sub.sort_indices()
+            sub = self._remove_degeneracies(sub)
+            exemplars = self._exemplars(sub)
+            # Each point joins the most similar exemplar it has an edge to.
+            best = self._assign(sub, exemplars)
+            if exemplars.any():
+                best = self._assign(sub, self._refine(sub, best))
+            labels[connected] = where(best >= 0, connected[maximum(best, 0)], -1)
+        unassigned = labels < 0
+        labels[unassigned] = arange(n)[unassigned]
+        _, labels = unique(labels, return_inverse=True)
+        return labels
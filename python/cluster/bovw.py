@@ -0,0 +1,188 @@
+import hashlib
+from enum import Enum
+from os.path import isfile
+from typing import List
+
+from numpy import (absolute, add, bincount, concatenate, float32, load,
+                   ndarray, save, sign, sqrt, zeros)
+from numpy.linalg import norm
+from numpy.random import RandomState
+from sklearn.cluster import AffinityPropagation, MiniBatchKMeans
+
+from cluster.descriptorstore import SiftDescriptorStore, SiftParameters
+from cluster.matching import Descriptors, descriptor_distances
+from cluster.sift import AffinityPropagationAffinity
+from core.cluster import ClusterRegistry, ClusterResults, ClusterStrategy
+from core.jl import ImageReduction, mkdirname
+from core.typing2 import Url
+
+
+class ImageEncoding(Enum):
+    BOVW = 'bovw'
+    VLAD = 'vlad'
+
+
+class VisualVocabulary(object):
+    """
+    A set of visual words learned by k-means from SIFT descriptors.
+    The vocabulary is saved per SIFT parameters, number of words, sample size, and the set of images it is learned from.
+    So a folder reuses its own vocabulary, and another set of images learns a new one instead of one fitted to an unrelated folder.
+    Images with fewer descriptors in total than words get one word per descriptor.
+    """
+
+    # Upper limit of descriptors in one distance matrix.
+    BATCH = 4096
+
+    def __init__(self, parameters: SiftParameters, words: int, keys: List[str], sample: int = 100000) -> None:
+        """
+        # Arguments
+        keys: content addresses of the descriptors that the vocabulary is learned from
+        """
+        self._parameters = parameters
+        self._words = words
+        self._sample = sample
+        md5 = hashlib.md5()
+        for key in sorted(set(keys)):
+            md5.update(key.encode())
+        self._data = md5.hexdigest()
+        self.centroids: ndarray = None
+
+    def url(self) -> Url:
+        return 'cache/vocabulary/%s/%d-%d-%s.npy' % (self._parameters.key(), self._words, self._sample, self._data)
+
+    def words(self) -> int:
+        """
+        Returns the number of visual words, which is less than asked for when there were too few descriptors.
+        """
+        return len(self.centroids)
+
+    def exists(self) -> bool:
+        return isfile(self.url())
+
+    def load(self) -> None:
+        print('LOADING: %s' % self.url())
+        self.centroids = load(self.url())
+
+    def save(self) -> None:
+        mkdirname(self.url())
+        print('SAVING: %s' % self.url())
+        save(self.url(), self.centroids)
+
+    def fit(self, descriptors: List[Descriptors]) -> None:
+        """
+        Learns the visual words from a random sample of descriptors.
+        There must be at least one descriptor.
+        """
+        x = concatenate(descriptors)
+        if len(x) > self._sample:
+            x = x[RandomState(0).choice(len(x), self._sample, replace=False)]
+        words = min(self._words, len(x))
+        print('VOCABULARY: %i words from %i descriptors' % (words, len(x)))
+        kmeans = MiniBatchKMeans(n_clusters=words, random_state=0, n_init=3)
+        self.centroids = kmeans.fit(x).cluster_centers_.astype(float32)
+
+    def assign(self, descriptors: Descriptors) -> ndarray:
+        """
+        Returns the nearest visual word of each descriptor.
+        """
+        words = [zeros(0, int)]
+        for start in range(0, len(descriptors), self.BATCH):
+            d = descriptor_distances(descriptors[start:start + self.BATCH], self.centroids)
+            words.append(d.argmin(axis=1))
+        return concatenate(words)
+
+    def bovw(self, descriptors: Descriptors) -> ndarray:
+        """
+        Returns the L2 normalized histogram of visual words of an image.
+        """
+        histogram = bincount(self.assign(descriptors), minlength=self.words()).astype(float32)
+        length = norm(histogram)
+        if length > 0:
+            histogram /= length
+        return histogram
+
+    def vlad(self, descriptors: Descriptors) -> ndarray:
+        """
+        Returns the vector of locally aggregated descriptors of an image.
+        Residuals from each visual word are summed, square-root normalized, and L2 normalized.
+        """
+        residuals = zeros(self.centroids.shape, float32)
+        words = self.assign(descriptors)
+        add.at(residuals, words, descriptors - self.centroids[words])
+        v = residuals.ravel()
+        v = sign(v) * sqrt(absolute(v))
+        length = norm(v)
+        if length > 0:
+            v /= length
+        return v
+
+    def encode(self, descriptors: Descriptors, encoding: ImageEncoding) -> ndarray:
+        """
+        Returns a fixed length vector of an image.
+        """
+        if encoding == ImageEncoding.VLAD:
+            return self.vlad(descriptors)
+        return self.bovw(descriptors)
+
+
+class BovwCluster(ClusterStrategy):
+    """
+    Clusters images by fixed length vectors encoded from their SIFT descriptors with a visual vocabulary.
+    Encoding is linear in the number of images, which replaces matching every pair of images.
+    """
+
+    def run(
+        self,
+        images: List[Url],
+        nfeatures: int = 0,
+        nOctaveLayers: int = 3,
+        contrastThreshold: float = 0.04,
+        edgeThreshold: float = 10,
+        sigma: float = 1.6,
+        words: int = 256,
+        encoding: ImageEncoding = ImageEncoding.VLAD,
+        sample: int = 100000,
+        damping: float = 0.5,
+        max_iter: int = 200,
+        convergence_iter: int = 15,
+        workers: int = 1,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+    ) -> ClusterResults:
+        if not isinstance(encoding, ImageEncoding):
+            encoding = ImageEncoding(encoding)
+        parameters = SiftParameters(
+            nfeatures,
+            nOctaveLayers,
+            contrastThreshold,
+            edgeThreshold,
+            sigma,
+            reduction,
+            max_side,
+        )
+        store = SiftDescriptorStore(parameters)
+        descriptors = store.get_all(images, workers)
+        if sum(len(d) for d in descriptors) == 0:
+            return ClusterResults(images, list(range(len(images))))
+        vocabulary = VisualVocabulary(parameters, words, store.keys(images), sample)
+        if vocabulary.exists():
+            vocabulary.load()
+        else:
+            vocabulary.fit(descriptors)
+            vocabulary.save()
+        print('ENCODING: %s' % encoding.value)
+        vectors = zeros((len(images), vocabulary.words() if encoding == ImageEncoding.BOVW else vocabulary.centroids.size), float32)
+        for i, d in enumerate(descriptors):
+            vectors[i] = vocabulary.encode(d, encoding)
+        print('CLUSTER: AffinityPropagation')
+        cluster = AffinityPropagation(
+            damping=damping,
+            max_iter=max_iter,
+            convergence_iter=convergence_iter,
+            affinity=AffinityPropagationAffinity.EUCLIDEAN.value,
+            random_state=0,
+        ).fit_predict(vectors).tolist()
+        return ClusterResults(images, cluster)
+
+
+ClusterRegistry.add('bovw', BovwCluster())
@@ -0,0 +1,194 @@
+from typing import List, Optional, Tuple
+
+from numpy import (argpartition, argsort, bincount, concatenate, cumsum,
+                   float32, full, inf, int64, isfinite, ndarray, ones, repeat,
+                   sqrt, take_along_axis, where)
+from numpy.random import RandomState
+from scipy.sparse import coo_matrix, csr_matrix
+from sklearn.cluster import MiniBatchKMeans
+
+from cluster.affinity import SparseAffinityPropagation
+from cluster.descriptorstore import SiftDescriptorStore, SiftParameters
+from cluster.matching import Descriptors, descriptor_distances
+from core.cluster import ClusterRegistry, ClusterResults, ClusterStrategy
+from core.jl import ImageReduction
+from core.typing2 import Url
+
+
+class IvfIndex(object):
+    """
+    An inverted file index over the descriptors of many images.
+    Descriptors are assigned to the nearest of a set of k-means centroids.
+    A query only searches the lists of its nearest centroids, which makes nearest neighbor search approximate but sub-quadratic.
+    """
+
+    # Upper limit of rows in one distance matrix.
+    BATCH = 4096
+
+    def __init__(self, lists: int, probes: int = 4, random_state: int = 0) -> None:
+        self._lists = lists
+        self._probes = min(probes, lists)
+        self._random_state = random_state
+        self._centroids: Optional[ndarray] = None
+
+    def _nearest_lists(self, x: ndarray, k: int) -> ndarray:
+        """
+        Returns the k nearest centroids of each descriptor.
+        """
+        results = list()
+        for start in range(0, len(x), self.BATCH):
+            d = descriptor_distances(x[start:start + self.BATCH], self._centroids)
+            if k < d.shape[1]:
+                d_idx = argpartition(d, k - 1, axis=1)[:, :k]
+            else:
+                d_idx = argsort(d, axis=1)
+            results.append(d_idx)
+        return concatenate(results)
+
+    def train(self, x: ndarray, sample: int = 100000) -> None:
+        """
+        Learns the centroids from a random sample of descriptors.
+        """
+        random_state = RandomState(self._random_state)
+        sample = max(sample, 40 * self._lists)
+        if len(x) > sample:
+            x = x[random_state.choice(len(x), sample, replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=self._lists, random_state=self._random_state, n_init=3)
+        self._centroids = kmeans.fit(x).cluster_centers_.astype(float32)
+
+    def search(self, x: ndarray, owners: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+        """
+        Returns the distances and indices of the approximate k nearest neighbors of every descriptor in the index among the descriptors of other images.
+        The index holds x, and owners is the image of each descriptor.
+        Neighbors are sorted from nearest to farthest.
+        Missing neighbors have an infinite distance and index -1.
+        """
+        n = len(x)
+        assignment = self._nearest_lists(x, 1)[:, 0]
+        members = argsort(assignment, kind='stable')
+        member_offsets = concatenate(([0], cumsum(bincount(assignment, minlength=self._lists))))
+        probes = self._nearest_lists(x, self._probes)
+        queries = argsort(probes.ravel(), kind='stable') // self._probes
+        query_offsets = concatenate(([0], cumsum(bincount(probes.ravel(), minlength=self._lists))))
+        best_distance = full((n, k), inf, float32)
+        best_index = full((n, k), -1, int64)
+        for l in range(self._lists):
+            m = members[member_offsets[l]:member_offsets[l + 1]]
+            q_all = queries[query_offsets[l]:query_offsets[l + 1]]
+            if len(m) == 0 or len(q_all) == 0:
+                continue
+            for start in range(0, len(q_all), self.BATCH):
+                q = q_all[start:start + self.BATCH]
+                d = descriptor_distances(x[q], x[m])
+                d[owners[q][:, None] == owners[m][None, :]] = inf
+                candidates = repeat(m[None, :], len(q), axis=0)
+                if k < len(m):
+                    part = argpartition(d, k - 1, axis=1)[:, :k]
+                    d = take_along_axis(d, part, axis=1)
+                    candidates = take_along_axis(candidates, part, axis=1)
+                d = concatenate((best_distance[q], d), axis=1)
+                candidates = concatenate((best_index[q], candidates), axis=1)
+                part = argpartition(d, k - 1, axis=1)[:, :k]
+                best_distance[q] = take_along_axis(d, part, axis=1)
+                best_index[q] = take_along_axis(candidates, part, axis=1)
+        order = argsort(best_distance, axis=1)
+        best_distance = take_along_axis(best_distance, order, axis=1)
+        best_index = take_along_axis(best_index, order, axis=1)
+        best_index[~isfinite(best_distance)] = -1
+        return best_distance, best_index
+
+
+def vote_graph(distances: ndarray, neighbors: ndarray, owners: ndarray, images: int, ratio: float) -> csr_matrix:
+    """
+    Returns a sparse matrix with the number of matching descriptors between each pair of images.
+    A query descriptor votes for each image among its nearest neighbors once.
+    The vote passes the ratio test if the nearest descriptor of that image is closer than the ratio times the second nearest one of the same image.
+    When the second nearest is not among the neighbors, the farthest neighbor is used as its lower bound.
+    """
+    n, k = neighbors.shape
+    valid = neighbors >= 0
+    image = where(valid, owners[where(valid, neighbors, 0)], -1)
+    bound = distances[:, k - 1]
+    rows = list()
+    cols = list()
+    for p in range(k):
+        first = valid[:, p].copy()
+        for q in range(p):
+            first &= image[:, p] != image[:, q]
+        second = full(n, inf, distances.dtype)
+        for q in reversed(range(p + 1, k)):
+            second = where(image[:, q] == image[:, p], distances[:, q], second)
+        second = where(isfinite(second), second, bound)
+        good = first & isfinite(second) & (distances[:, p] < ratio * second)
+        rows.append(owners[good])
+        cols.append(image[good, p])
+    rows = concatenate(rows)
+    cols = concatenate(cols)
+    votes = coo_matrix((ones(len(rows)), (rows, cols)), shape=(images, images)).tocsr()
+    return votes + votes.T
+
+
+class SiftIndexCluster(ClusterStrategy):
+    """
+    Clusters images from SIFT descriptors without comparing every pair of images.
+    All descriptors go into one approximate nearest neighbor index that every descriptor queries once.
+    Matching descriptors vote for a sparse similarity graph that is clustered by sparse affinity propagation.
+    """
+
+    def run(
+        self,
+        images: List[Url],
+        nfeatures: int = 0,
+        nOctaveLayers: int = 3,
+        contrastThreshold: float = 0.04,
+        edgeThreshold: float = 10,
+        sigma: float = 1.6,
+        ratio: float = 0.8,
+        lists: int = 0,
+        probes: int = 4,
+        neighbors: int = 10,
+        min_votes: int = 2,
+        damping: float = 0.5,
+        max_iter: int = 200,
+        convergence_iter: int = 15,
+        preference: Optional[float] = None,
+        workers: int = 1,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+    ) -> ClusterResults:
+        store = SiftDescriptorStore(SiftParameters(
+            nfeatures,
+            nOctaveLayers,
+            contrastThreshold,
+            edgeThreshold,
+            sigma,
+            reduction,
+            max_side,
+        ))
+        descriptors: List[Descriptors] = store.get_all(images, workers)
+        x = concatenate(descriptors)
+        owners = repeat(range(len(images)), [len(d) for d in descriptors])
+        if len(x) == 0:
+            return ClusterResults(images, list(range(len(images))))
+        if lists <= 0:
+            lists = max(1, int(4 * sqrt(len(x))))
+        lists = max(1, min(lists, len(x)))
+        print('INDEX: %i descriptors in %i lists' % (len(x), lists))
+        index = IvfIndex(lists, probes)
+        index.train(x)
+        print('INDEX: searching')
+        distances, neighbors = index.search(x, owners, neighbors)
+        graph = vote_graph(distances, neighbors, owners, len(images), ratio)
+        graph.data[graph.data < min_votes] = 0
+        graph.eliminate_zeros()
+        print('CLUSTER: SparseAffinityPropagation (%i edges)' % graph.nnz)
+        cluster = SparseAffinityPropagation(
+            damping=damping,
+            max_iter=max_iter,
+            convergence_iter=convergence_iter,
+            preference=preference,
+        ).fit_predict(graph).tolist()
+        return ClusterResults(images, cluster)
+
+
+ClusterRegistry.add('siftivf', SiftIndexCluster())
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from os.path import isfile
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+
+import cv2
+from numpy import float32, load, ndarray, save, uint8, zeros
+
+from core.fingerprint import fingerprint
+from core.jl import ImageReduction, mkdirname, read_image
+from core.typing2 import Image, Url
+
+Descriptors = ndarray
+
+
+class SiftParameters(object):
+    """
+    The arguments of cv2.xfeatures2d.SIFT_create and the resolution that images are decoded at for it.
+    """
+
+    def __init__(
+        self,
+        nfeatures: int = 0,
+        nOctaveLayers: int = 3,
+        contrastThreshold: float = 0.04,
+        edgeThreshold: float = 10,
+        sigma: float = 1.6,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+    ) -> None:
+        if not isinstance(reduction, ImageReduction):
+            reduction = ImageReduction(reduction)
+        self.nfeatures = nfeatures
+        self.nOctaveLayers = nOctaveLayers
+        self.contrastThreshold = contrastThreshold
+        self.edgeThreshold = edgeThreshold
+        self.sigma = sigma
+        self.reduction = reduction
+        self.max_side = max_side
+
+    def create(self) -> cv2.Feature2D:
+        """
+        Returns a new SIFT feature detector.
+        """
+        return cv2.xfeatures2d.SIFT_create(
+            self.nfeatures,
+            self.nOctaveLayers,
+            self.contrastThreshold,
+            self.edgeThreshold,
+            self.sigma,
+        )
+
+    def read(self, image: Url) -> Image:
+        """
+        Decodes an image at the resolution for SIFT.
+        """
+        return read_image(image, self.reduction, self.max_side)
+
+    def key(self) -> str:
+        """
+        Returns a hash of the parameters.
+        Full resolution decoding leaves the hash as it was before the decoding settings existed.
+        """
+        parameters = [
+            self.nfeatures,
+            self.nOctaveLayers,
+            self.contrastThreshold,
+            self.edgeThreshold,
+            self.sigma,
+        ]
+        if self.reduction != ImageReduction.FULL or self.max_side > 0:
+            parameters += [self.reduction.value, self.max_side]
+        md5 = hashlib.md5()
+        md5.update(json.dumps(parameters).encode())
+        return md5.hexdigest()
+
+
+class SiftDescriptorStore(object):
+    """
+    Content-addressed storage of SIFT descriptors.
+    Descriptors are saved once per file content and SIFT parameters so only new images pay for extraction.
+    SIFT descriptor values are integers between 0 and 255 so they are stored losslessly as uint8 NumPy files, which are memory-mapped on load.
+    """
+
+    def __init__(self, parameters: SiftParameters) -> None:
+        self._parameters = parameters
+        self._sift = None
+        self._hashes: Dict[Url, str] = dict()
+
+    def file_hash(self, image: Url) -> str:
+        """
+        Returns the hash of the file contents of an image.
+        """
+        if image not in self._hashes:
+            self._hashes[image] = fingerprint(image)
+        return self._hashes[image]
+
+    def key(self, image: Url) -> str:
+        """
+        Returns the content address of the descriptors of an image.
+        """
+        md5 = hashlib.md5()
+        md5.update(self.file_hash(image).encode())
+        md5.update(self._parameters.key().encode())
+        return md5.hexdigest()
+
+    def keys(self, images: List[Url]) -> List[str]:
+        """
+        Returns the content addresses of the descriptors of a list of images.
+        """
+        return [self.key(i) for i in images]
+
+    def _path(self, image: Url) -> Url:
+        return 'cache/descriptors/%s/%s.npy' % (self._parameters.key(), self.file_hash(image))
+
+    def contains(self, image: Url) -> bool:
+        """
+        Returns true if the descriptors of an image are already stored.
+        """
+        return isfile(self._path(image))
+
+    def extract(self, image: Url) -> Descriptors:
+        """
+        Returns the SIFT descriptors of an image without using the store.
+        """
+        if self._sift is None:
+            self._sift = self._parameters.create()
+        print("SIFT DESCRIPTORS: %s" % image)
+        _, descriptors = self._sift.detectAndCompute(image=self._parameters.read(image), mask=None)
+        if descriptors is None:
+            descriptors = zeros((0, 128), float32)
+        return descriptors
+
+    def put(self, image: Url, descriptors: Descriptors) -> None:
+        """
+        Saves the descriptors of an image.
+        The file is written under a temporary name first so readers never see a partial file.
+        """
+        filepath = self._path(image)
+        mkdirname(filepath, False)
+        temp = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(temp, 'wb') as f:
+            save(f, descriptors.astype(uint8))
+        os.replace(temp, filepath)
+
+    def get(self, image: Url) -> Descriptors:
+        """
+        Returns the SIFT descriptors of an image as a read-only uint8 memory map.
+        Extracts and saves them if they are not stored yet.
+        Consumers convert them to floating point one block at a time.
+        """
+        filepath = self._path(image)
+        if not isfile(filepath):
+            self.put(image, self.extract(image))
+        return load(filepath, mmap_mode='r')
+
+    def get_all(self, images: List[Url], workers: int = 1) -> List[Descriptors]:
+        """
+        Returns the SIFT descriptors of a list of images.
+        With more than one worker, missing descriptors are extracted by an ExtractionPipeline first.
+        """
+        if workers > 1:
+            missing = list(dict.fromkeys(i for i in images if not self.contains(i)))
+            if len(missing) > 1:
+                ExtractionPipeline(self._parameters, workers).run(self, missing)
+        return [self.get(i) for i in images]
+
+
+_EXTRACTOR: Dict[str, Any] = dict()
+
+
+def _init_extractor(parameters: SiftParameters) -> None:
+    """
+    Initializes a worker process with its own SIFT feature detector.
+    """
+    _EXTRACTOR['sift'] = parameters.create()
+
+
+def _extract(gray: ndarray) -> Tuple[Descriptors, float]:
+    """
+    Returns the SIFT descriptors of a grayscale image and the seconds spent on them inside a worker process.
+    """
+    start = perf_counter()
+    _, descriptors = _EXTRACTOR['sift'].detectAndCompute(image=gray, mask=None)
+    if descriptors is None:
+        descriptors = zeros((0, 128), float32)
+    return descriptors, perf_counter() - start
+
+
+class ExtractionPipeline(object):
+    """
+    Extracts SIFT descriptors of many images in two overlapping stages.
+    A pool of reader threads decodes JPEG files to grayscale, since OpenCV releases the GIL while decoding.
+    A pool of processes runs SIFT on the decoded images.
+    Both stages are bounded, so at most a few decoded images wait in memory at any time.
+    SIFT converts color images to grayscale itself, so the descriptors are the same as SiftDescriptorStore.extract.
+    """
+
+    def __init__(self, parameters: SiftParameters, workers: int, readers: int = 2, queue_size: int = 0) -> None:
+        self._parameters = parameters
+        self._workers = max(1, workers)
+        self._readers = max(1, readers)
+        self._queue_size = queue_size if queue_size > 0 else 2 * self._workers
+
+    def _read(self, images: List[Url], decoded: Queue, lock: Lock, state: Dict[str, Any]) -> None:
+        """
+        Decodes images until none are left and puts them in the queue of decoded images.
+        """
+        while True:
+            with lock:
+                index = state['next']
+                state['next'] += 1
+            if index >= len(images):
+                return
+            start = perf_counter()
+            try:
+                gray = cv2.cvtColor(self._parameters.read(images[index]), cv2.COLOR_BGR2GRAY)
+            except Exception as e:
+                gray = e
+            with lock:
+                state['decode'] += perf_counter() - start
+            decoded.put((index, gray))
+
+    def run(self, store: SiftDescriptorStore, images: List[Url]) -> None:
+        """
+        Extracts the descriptors of a list of images and saves them in a store.
+        """
+        start = perf_counter()
+        decoded: Queue = Queue(self._queue_size)
+        lock = Lock()
+        state = {'next': 0, 'decode': 0.0}
+        readers = [Thread(target=self._read, args=(images, decoded, lock, state), daemon=True) for _ in range(self._readers)]
+        for reader in readers:
+            reader.start()
+        extract = 0.0
+        submitted = 0
+        completed = 0
+        pending = dict()
+        with ProcessPoolExecutor(self._workers, initializer=_init_extractor, initargs=(self._parameters,)) as pool:
+            while completed < len(images):
+                while submitted < len(images) and len(pending) < self._queue_size:
+                    try:
+                        index, gray = decoded.get(block=len(pending) == 0)
+                    except Empty:
+                        break
+                    if isinstance(gray, Exception):
+                        raise gray
+                    pending[pool.submit(_extract, gray)] = index
+                    submitted += 1
+                done, _ = wait(list(pending), timeout=None if submitted == len(images) else 0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    descriptors, seconds = future.result()
+                    store.put(images[index], descriptors)
+                    extract += seconds
+                    completed += 1
+                    print("SIFT DESCRIPTORS: %i / %i %s" % (completed, len(images), images[index]))
+        for reader in readers:
+            reader.join()
+        elapsed = max(perf_counter() - start, 1e-9)
+        print('SIFT EXTRACTION: %i images in %.1f s (%.1f images/s), decode %.0f%% of %i threads, extract %.0f%% of %i processes' % (
+            len(images),
+            elapsed,
+            len(images) / elapsed,
+            100 * state['decode'] / (elapsed * self._readers),
+            self._readers,
+            100 * extract / (elapsed * self._workers),
+            self._workers,
+        ))
@@ -0,0 +1,153 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from typing import Any, Dict, List, Optional, Tuple
+
+from numpy import float32, ndarray, vstack, zeros
+
+from cluster.descriptorstore import SiftDescriptorStore, SiftParameters
+from cluster.histogram import HistogramStore, HsvHistogramBatch
+from core.jl import ImageReduction, hsv, read_image
+from core.typing2 import Image, Url
+
+Decoding = Tuple[ImageReduction, int]
+
+
+class FeatureExtractor(ABC):
+    """
+    A kind of feature that is computed from a decoded image and kept in a store.
+    """
+
+    @abstractmethod
+    def decoding(self) -> Decoding:
+        """
+        Returns the reduction and maximum side that images are decoded with for this feature.
+        """
+        pass
+
+    @abstractmethod
+    def missing(self, images: List[Url]) -> List[Url]:
+        """
+        Returns the images whose features are not stored yet.
+        """
+        pass
+
+    @abstractmethod
+    def extract(self, image: Image) -> Any:
+        """
+        Returns the feature of a decoded BGR image.
+        Called from many threads at once.
+        """
+        pass
+
+    @abstractmethod
+    def put(self, image: Url, feature: Any) -> None:
+        """
+        Keeps the feature of an image.
+        """
+        pass
+
+    def flush(self) -> None:
+        """
+        Saves the features that were kept but not saved yet.
+        """
+        pass
+
+
+class SiftFeatureExtractor(FeatureExtractor):
+    """
+    SIFT descriptors saved in a SiftDescriptorStore.
+    """
+
+    def __init__(self, parameters: SiftParameters) -> None:
+        self._parameters = parameters
+        self._store = SiftDescriptorStore(parameters)
+        # SIFT detectors are not shared between threads.
+        self._local = local()
+
+    def decoding(self) -> Decoding:
+        return self._parameters.reduction, self._parameters.max_side
+
+    def missing(self, images: List[Url]) -> List[Url]:
+        return [i for i in dict.fromkeys(images) if not self._store.contains(i)]
+
+    def extract(self, image: Image) -> Any:
+        if not hasattr(self._local, 'sift'):
+            self._local.sift = self._parameters.create()
+        _, descriptors = self._local.sift.detectAndCompute(image=image, mask=None)
+        if descriptors is None:
+            descriptors = zeros((0, 128), float32)
+        return descriptors
+
+    def put(self, image: Url, feature: Any) -> None:
+        self._store.put(image, feature)
+
+
+class HistogramFeatureExtractor(FeatureExtractor):
+    """
+    HSV histograms saved in a HistogramStore.
+    """
+
+    def __init__(self, batch: HsvHistogramBatch) -> None:
+        self._batch = batch
+        self._store = HistogramStore(batch)
+        self._images: List[Url] = list()
+        self._features: List[ndarray] = list()
+
+    def decoding(self) -> Decoding:
+        return self._batch.decoding()
+
+    def missing(self, images: List[Url]) -> List[Url]:
+        return self._store.missing(images)
+
+    def extract(self, image: Image) -> Any:
+        return self._batch.histogram(hsv(image))
+
+    def put(self, image: Url, feature: Any) -> None:
+        self._images.append(image)
+        self._features.append(feature)
+
+    def flush(self) -> None:
+        if len(self._images) > 0:
+            self._store.add(self._images, vstack(self._features))
+        self._images = list()
+        self._features = list()
+
+
+class FeaturePipeline(object):
+    """
+    Computes every missing feature of many images while decoding each image once.
+    Extractors that decode images the same way share the decoded image.
+    Images are decoded and processed on a thread pool, since OpenCV releases the GIL.
+    """
+
+    def __init__(self, extractors: List[FeatureExtractor], workers: int = 1) -> None:
+        self._extractors = extractors
+        self._workers = max(1, workers)
+
+    def run(self, images: List[Url]) -> None:
+        """
+        Computes and saves the features that are not stored yet.
+        """
+        groups: Dict[Decoding, List[FeatureExtractor]] = dict()
+        for extractor in self._extractors:
+            groups.setdefault(extractor.decoding(), list()).append(extractor)
+        for (reduction, max_side), extractors in groups.items():
+            missing = [set(e.missing(images)) for e in extractors]
+            todo = [i for i in dict.fromkeys(images) if any(i in m for m in missing)]
+            if len(todo) == 0:
+                continue
+            print('FEATURES: decoding %i images once for %i extractors' % (len(todo), len(extractors)))
+
+            def work(image: Url) -> List[Optional[Any]]:
+                decoded = read_image(image, reduction, max_side)
+                return [e.extract(decoded) if image in m else None for e, m in zip(extractors, missing)]
+
+            with ThreadPoolExecutor(self._workers) as pool:
+                for n, (image, features) in enumerate(zip(todo, pool.map(work, todo)), 1):
+                    print('FEATURES: %i / %i %s' % (n, len(todo), image))
+                    for e, m, feature in zip(extractors, missing, features):
+                        if image in m:
+                            e.put(image, feature)
+            for e in extractors:
+                e.flush()
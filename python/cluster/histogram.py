@@ -1,11 +1,22 @@
-from typing import Dict, List, Optional
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from os.path import isdir, isfile
+from time import time
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 from core.cluster import ClusterRegistry, ClusterResults, ClusterStrategy
-from core.jl import hsv, read_image
-from core.typing2 import Url
-from numpy import concatenate, ndarray, reshape, vstack
-from sklearn.cluster import MeanShift
+from core.fingerprint import fingerprint
+from core.jl import ImageReduction, hsv, mkdirname, mkdirs, read_image
+from core.typing2 import Image, Url
+from numpy import (arange, array, bincount, concatenate, float32, full, intp,
+                   load, ndarray, reshape, savez, zeros)
+from numpy.random import RandomState
+from sklearn.cluster import MeanShift, estimate_bandwidth
+from sklearn.decomposition import PCA
 
 
 Histogram = ndarray
@@ -16,9 +27,9 @@ class HsvHistogram(object):
     hue-saturation-value
     """
 
-    def __init__(self, image: Url) -> None:
+    def __init__(self, image: Url, reduction: ImageReduction = ImageReduction.FULL, max_side: int = 0) -> None:
         self._url = image
-        self._image = hsv(read_image(image))
+        self._image = hsv(read_image(image, reduction, max_side))
 
     def _histogram(self, channel: int, range: int) -> Histogram:
         """
@@ -76,6 +87,307 @@ class HsvHistogram(object):
         return histogram / pixels
 
 
+class HsvHistogramBatch(object):
+    """
+    Computes the scaled HSV histograms of many images into one feature matrix.
+    A lookup table maps each channel value to its bin in the combined histogram, so one bincount per image counts all three channels.
+    Values outside of the bins of a channel go to an extra bin that is discarded, which is what calcHist does with the same ranges.
+    Images are decoded and counted on a thread pool.
+    """
+
+    def __init__(
+        self,
+        hue: int = 180,
+        saturation: int = 256,
+        value: int = 256,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+        workers: int = 1,
+    ) -> None:
+        if not isinstance(reduction, ImageReduction):
+            reduction = ImageReduction(reduction)
+        self._bins = [hue, saturation, value]
+        self._size = hue + saturation + value
+        self._reduction = reduction
+        self._max_side = max_side
+        self._workers = max(1, workers)
+        self._lut = full((3, 256), self._size, intp)
+        offset = 0
+        for channel, bins in enumerate(self._bins):
+            values = arange(min(bins, 256))
+            self._lut[channel, values] = offset + values
+            offset += bins
+
+    def size(self) -> int:
+        """
+        Returns the length of a combined histogram.
+        """
+        return self._size
+
+    def decoding(self) -> Tuple[ImageReduction, int]:
+        """
+        Returns the reduction and maximum side that images are decoded with.
+        """
+        return self._reduction, self._max_side
+
+    def key(self) -> str:
+        """
+        Returns a hash of the settings that affect the histograms.
+        """
+        md5 = hashlib.md5()
+        md5.update(json.dumps(self._bins + [self._reduction.value, self._max_side]).encode())
+        return md5.hexdigest()
+
+    def histogram(self, image: Image) -> ndarray:
+        """
+        Returns the combined histogram of an HSV image scaled by its number of pixels.
+        """
+        height, width, _ = image.shape
+        counts = bincount(self._lut[arange(3), image].ravel(), minlength=self._size + 1)[:self._size]
+        return counts.astype(float32) / float32(height * width)
+
+    def compute(self, images: List[Url]) -> ndarray:
+        """
+        Returns a matrix with the histogram of each image in a row.
+        """
+        features = zeros((len(images), self._size), float32)
+
+        def work(i: int) -> None:
+            print("HISTOGRAM: %i / %i" % (i, len(images)))
+            features[i] = self.histogram(hsv(read_image(images[i], self._reduction, self._max_side)))
+
+        if self._workers == 1:
+            for i in range(len(images)):
+                work(i)
+        else:
+            with ThreadPoolExecutor(self._workers) as pool:
+                list(pool.map(work, range(len(images))))
+        return features
+
+
+class HistogramStore(object):
+    """
+    Histograms of images saved per file content and histogram settings.
+    Each batch of new histograms is appended as one NumPy archive that holds both the file hashes and the histograms.
+    Archives are written under temporary names and renamed, so the two columns always match and writers never overwrite each other.
+    When there are many archives, they are merged into one, so every cached histogram still loads with a few reads.
+    Only images that are not in the store are decoded.
+    """
+
+    # Number of archives that are merged into one.
+    MERGE = 16
+
+    def __init__(self, batch: HsvHistogramBatch) -> None:
+        self._batch = batch
+        self._directory = 'cache/histograms/%s' % batch.key()
+        self._keys = zeros(0, 'S32')
+        self._features = zeros((0, batch.size()), float32)
+        self._rows: Optional[Dict[bytes, int]] = None
+        self._segments: List[Url] = list()
+        self._hashes: Dict[Url, bytes] = dict()
+
+    def _url(self, column: str) -> Url:
+        return '%s/%s.npy' % (self._directory, column)
+
+    def file_hash(self, image: Url) -> bytes:
+        """
+        Returns the hash of the file contents of an image.
+        """
+        if image not in self._hashes:
+            self._hashes[image] = fingerprint(image).encode()
+        return self._hashes[image]
+
+    def _load(self) -> Dict[bytes, int]:
+        """
+        Loads every archive once and returns the row of each file hash.
+        Columns saved before the archives are read as well.
+        """
+        if self._rows is not None:
+            return self._rows
+        keys = [self._keys]
+        features = [self._features]
+        if isfile(self._url('keys')) and isfile(self._url('features')):
+            legacy_keys = load(self._url('keys'))
+            legacy_features = load(self._url('features'))
+            if len(legacy_keys) == len(legacy_features):
+                keys.append(legacy_keys)
+                features.append(legacy_features)
+        if isdir(self._directory):
+            print('LOADING: %s' % self._directory)
+            for name in sorted(os.listdir(self._directory)):
+                if not name.endswith('.npz'):
+                    continue
+                url = '%s/%s' % (self._directory, name)
+                try:
+                    with load(url) as archive:
+                        keys.append(archive['keys'])
+                        features.append(archive['features'])
+                except FileNotFoundError:
+                    # Merged into another archive by another process.
+                    continue
+                self._segments.append(url)
+        self._keys = concatenate(keys)
+        self._features = concatenate(features)
+        self._rows = {k: i for i, k in enumerate(self._keys.tolist())}
+        return self._rows
+
+    def _save_segment(self, keys: ndarray, features: ndarray) -> Url:
+        url = '%s/%.6f-%d.npz' % (self._directory, time(), os.getpid())
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        with open(temp, 'wb') as f:
+            savez(f, keys=keys, features=features)
+        os.replace(temp, url)
+        return url
+
+    def _merge(self) -> None:
+        """
+        Replaces the archives and the older columns with one archive of every histogram.
+        Another process that merges at the same time only leaves a duplicate archive, which a later merge removes.
+        """
+        print('MERGING: %s' % self._directory)
+        rows = sorted(self._rows.values())
+        url = self._save_segment(self._keys[rows], self._features[rows])
+        for old in self._segments + [self._url('keys'), self._url('features')]:
+            if old != url and isfile(old):
+                os.remove(old)
+        self._keys = self._keys[rows]
+        self._features = self._features[rows]
+        self._rows = {k: i for i, k in enumerate(self._keys.tolist())}
+        self._segments = [url]
+
+    def missing(self, images: List[Url]) -> List[Url]:
+        """
+        Returns the images whose histograms are not stored, one per file content.
+        """
+        rows = self._load()
+        missing = dict()
+        for i in images:
+            h = self.file_hash(i)
+            if h not in rows:
+                missing.setdefault(h, i)
+        return list(missing.values())
+
+    def add(self, images: List[Url], features: ndarray) -> None:
+        """
+        Appends the histograms of images to the store as a new archive.
+        """
+        self._load()
+        keys = array([self.file_hash(i) for i in images], 'S32')
+        mkdirs(self._directory, False)
+        print('SAVING: %s' % self._directory)
+        self._segments.append(self._save_segment(keys, features))
+        offset = len(self._keys)
+        self._keys = concatenate((self._keys, keys))
+        self._features = concatenate((self._features, features))
+        self._rows.update((k, offset + i) for i, k in enumerate(keys.tolist()))
+        if len(self._segments) >= self.MERGE:
+            self._merge()
+
+    def get_all(self, images: List[Url]) -> ndarray:
+        """
+        Returns a matrix with the histogram of each image in a row.
+        Histograms that are not stored yet are computed and appended to the store.
+        """
+        missing = self.missing(images)
+        print('HISTOGRAM: %i new' % len(missing))
+        if len(missing) > 0:
+            self.add(missing, self._batch.compute(missing))
+        rows = self._load()
+        hashes = [self.file_hash(i) for i in images]
+        return array(self._features[[rows[h] for h in hashes]], float32).reshape((len(images), self._batch.size()))
+
+
+class MeanShiftMode(Enum):
+    EXACT = 'exact'
+    FAST = 'fast'
+
+
+class BandwidthCache(object):
+    """
+    Bandwidths estimated from samples of features.
+    A sample is identified by a hash of its values, so an estimate is reused only for the same data.
+    Only the most recently used estimates are kept.
+    """
+
+    URL = 'cache/bandwidth.json'
+    MAX_ENTRIES = 1000
+
+    def __init__(self, url: Url = URL, max_entries: int = MAX_ENTRIES) -> None:
+        self._url = url
+        self._max_entries = max_entries
+
+    def _load(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the bandwidth and last access time of each sample.
+        Estimates saved without an access time are the oldest.
+        """
+        if not isfile(self._url):
+            return dict()
+        try:
+            with open(self._url) as f:
+                bandwidths = json.load(f)
+        except ValueError:
+            return dict()
+        return {k: v if isinstance(v, dict) else {'bandwidth': v, 'atime': 0} for k, v in bandwidths.items()}
+
+    def _save(self, bandwidths: Dict[str, Dict[str, float]]) -> None:
+        """
+        Saves the most recently used estimates.
+        """
+        keys = sorted(bandwidths, key=lambda k: bandwidths[k]['atime'])[-self._max_entries:]
+        mkdirname(self._url, False)
+        temp = '%s.%d.tmp' % (self._url, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({k: bandwidths[k] for k in keys}, f)
+        os.replace(temp, self._url)
+
+    def estimate(self, sample: ndarray, quantile: float) -> float:
+        """
+        Returns the bandwidth of a sample for mean shift.
+        """
+        md5 = hashlib.md5()
+        md5.update(repr((sample.shape, quantile)).encode())
+        md5.update(sample.tobytes())
+        key = md5.hexdigest()
+        bandwidths = self._load()
+        if key in bandwidths:
+            bandwidth = bandwidths[key]['bandwidth']
+        else:
+            print('BANDWIDTH: estimating from %i samples' % len(sample))
+            bandwidth = float(estimate_bandwidth(sample, quantile=quantile))
+        bandwidths[key] = {'bandwidth': bandwidth, 'atime': time()}
+        self._save(bandwidths)
+        return bandwidth
+
+
+def fast_mean_shift(
+    features: ndarray,
+    bandwidth: Optional[float] = None,
+    components: int = 32,
+    sample: int = 1000,
+    quantile: float = 0.3,
+    workers: int = 1,
+) -> ndarray:
+    """
+    Clusters features by mean shift in a space reduced by PCA.
+    Seeds are the centers of a grid with cells the size of the bandwidth instead of every point.
+    Without a bandwidth, it is estimated from a random sample of points and cached.
+    """
+    n, dimensions = features.shape
+    components = max(1, min(components, n, dimensions))
+    reduced = PCA(n_components=components, random_state=0).fit_transform(features)
+    if bandwidth is None:
+        if n > sample:
+            reduced_sample = reduced[RandomState(0).choice(n, sample, replace=False)]
+        else:
+            reduced_sample = reduced
+        bandwidth = BandwidthCache().estimate(reduced_sample, quantile)
+    # A zero bandwidth means the sampled points are identical.
+    bandwidth = max(bandwidth, 1e-6)
+    print('CLUSTER: Mean Shift (%i components, bandwidth %g)' % (components, bandwidth))
+    return MeanShift(bandwidth=bandwidth, bin_seeding=True, n_jobs=workers).fit_predict(reduced)
+
+
 class HistogramCluster(ClusterStrategy):
     """
     """
@@ -87,19 +399,30 @@ class HistogramCluster(ClusterStrategy):
         saturation_bins: int = 256,
         value_bins: int = 256,
         bandwidth: Optional[float] = None,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+        workers: int = 1,
+        mode: MeanShiftMode = MeanShiftMode.EXACT,
+        components: int = 32,
+        sample: int = 1000,
+        quantile: float = 0.3,
     ) -> ClusterResults:
         """
         Clusters images.
+        Histograms are scaled by the number of pixels, so a reduced resolution barely changes them.
+        The fast mode trades exactness for speed on large folders.
         """
-        c = list()
-        for i, img in enumerate(images):
-            print("HISTOGRAM: %i / %i" % (i, len(images)))
-            hh = HsvHistogram(img)
-            histogram = HsvHistogram.scale(hh.hsv(hue_bins, saturation_bins, value_bins), hh.size())
-            c.append(histogram)
-        d = vstack(c)
-        print('CLUSTER: Mean Shift')
-        cluster = MeanShift(bandwidth=bandwidth).fit_predict(d).tolist()
+        if not isinstance(reduction, ImageReduction):
+            reduction = ImageReduction(reduction)
+        if not isinstance(mode, MeanShiftMode):
+            mode = MeanShiftMode(mode)
+        batch = HsvHistogramBatch(hue_bins, saturation_bins, value_bins, reduction, max_side, workers)
+        d = HistogramStore(batch).get_all(images)
+        if mode == MeanShiftMode.FAST:
+            cluster = fast_mean_shift(d, bandwidth, components, sample, quantile, workers).tolist()
+        else:
+            print('CLUSTER: Mean Shift')
+            cluster = MeanShift(bandwidth=bandwidth, n_jobs=workers).fit_predict(d).tolist()
         return ClusterResults(images, cluster)
 
 
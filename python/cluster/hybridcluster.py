@@ -1,12 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
 from core.cluster import ClusterRegistry, ClusterResults, ClusterStrategy
+from core.jl import ImageReduction
 from core.typing2 import Url
+from numpy import full, int64, ndarray, unique
 
-from cluster.histogram import HistogramCluster
+from cluster.descriptorstore import SiftParameters
+from cluster.features import (FeatureExtractor, FeaturePipeline,
+                              HistogramFeatureExtractor, SiftFeatureExtractor)
+from cluster.histogram import HistogramCluster, HsvHistogramBatch
 from cluster.sift import (AffinityPropagationAffinity, DescriptorMatcher,
-                          SiftCluster, SiftCluster2, Similarity, Similarity1,
-                          Similarity2, Similarity3, SimilarityMetric)
+                          SiftCluster, SiftCluster2, SiftDescriptorSet,
+                          Similarity, Similarity1, Similarity2, Similarity3,
+                          SimilarityMetric)
 
 
 class HybridCluster(ClusterStrategy):
@@ -17,81 +24,109 @@ class HybridCluster(ClusterStrategy):
         self._sift = SiftCluster(similarity)
         self._hist = HistogramCluster()
 
-    def run(self, images: List[Url]) -> ClusterResults:
+    def run(
+        self,
+        images: List[Url],
+        workers: int = 1,
+        sift_reduction: ImageReduction = ImageReduction.FULL,
+        sift_max_side: int = 0,
+        histogram_reduction: ImageReduction = ImageReduction.FULL,
+        histogram_max_side: int = 0,
+    ) -> ClusterResults:
         """
         Clusters images.
         """
-        results1 = self._sift.run(images)
-        results2 = self._hist.run(images)
-        labels1 = results1.labels()
-        labels2 = results2.labels()
+        self.extract_features(
+            images,
+            SiftParameters(nfeatures=SiftDescriptorSet.FEATURES, reduction=sift_reduction, max_side=sift_max_side),
+            HsvHistogramBatch(reduction=histogram_reduction, max_side=histogram_max_side),
+            workers,
+        )
+        results1 = self._sift.run(images, workers, reduction=sift_reduction, max_side=sift_max_side)
+        results2 = self._hist.run(images, reduction=histogram_reduction, max_side=histogram_max_side, workers=workers)
         k1 = results1.k()
-        cluster = [self.combine(c1, c2, k1)
-                   for c1, c2 in zip(labels1, labels2)]
+        cluster = self.combine(results1.label_array(), results2.label_array().astype(int64), k1).tolist()
         self.remove_empty_clusters(cluster)
         return ClusterResults(images, cluster)
 
     @staticmethod
-    def combine(label1: int, label2: int, k1: int) -> int:
+    def extract_features(
+        images: List[Url],
+        sift: Optional[SiftParameters],
+        histogram: Optional[HsvHistogramBatch],
+        workers: int = 1,
+    ) -> None:
         """
-        Returns a new cluster label by combining two cluster labels.
+        Decodes each image once to compute both its SIFT descriptors and its histogram before the stages run.
+        The stages then find their features in the caches.
+        A feature without settings is skipped.
         """
-        return label1 + label2 * k1
+        extractors: List[FeatureExtractor] = list()
+        if sift is not None:
+            extractors.append(SiftFeatureExtractor(sift))
+        if histogram is not None:
+            extractors.append(HistogramFeatureExtractor(histogram))
+        if len(extractors) > 0:
+            FeaturePipeline(extractors, workers).run(images)
 
     @staticmethod
-    def _next_lowest(min_: int, clusters: List[int]) -> int:
+    def combine(label1: int, label2: int, k1: int) -> int:
         """
-        Returns the lowest integer from the list of integers no lower than the given minimum.
-        Returns none if there is no integer greater or equal to the minimum.
+        Returns a new cluster label by combining two cluster labels.
+        Also combines arrays of labels element by element.
         """
-        lowest = None
-        for i in clusters:
-            if lowest == None:
-                if min_ <= i:
-                    lowest = i
-            elif min_ <= i <= lowest:
-                lowest = i
-        return lowest
+        return label1 + label2 * k1
 
     @staticmethod
-    def _replace_all(l: List[int], old: int, new: int) -> None:
+    def remove_empty_clusters(clusters: List[int]) -> None:
         """
+        Renumbers cluster labels in place so they are consecutive from zero while keeping their order.
         """
-        for i, e in enumerate(l):
-            if e == old:
-                l[i] = new
-        return
-
-    def remove_empty_clusters(self, clusters: List[int]) -> None:
-        """
-        """
-        k = max(clusters) + 1
-        for i in range(k):
-            j = self._next_lowest(i, clusters)
-            if j == None:
-                return
-            elif i < j:
-                self._replace_all(clusters, j, i)
-        return
+        clusters[:] = unique(clusters, return_inverse=True)[1].tolist()
 
 
 class HybridCluster2(HybridCluster):
     """
     """
 
-    def run(self, images: List[Url]) -> ClusterResults:
+    def run(
+        self,
+        images: List[Url],
+        workers: int = 1,
+        sift_reduction: ImageReduction = ImageReduction.FULL,
+        sift_max_side: int = 0,
+        histogram_reduction: ImageReduction = ImageReduction.FULL,
+        histogram_max_side: int = 0,
+    ) -> ClusterResults:
         """
         Clusters images.
         """
-        results1 = self._hist.run(images)
-        cluster = [-1] * len(images)
-        for label1, urls1 in enumerate(results1.urls()):
-            results2 = self._sift.run(urls1)
-            for label2, urls2 in enumerate(results2.urls()):
-                label3 = self.combine(label1, label2, results1.k())
-                for url2 in urls2:
-                    i = images.index(url2)
-                    cluster[i] = label3
+        self.extract_features(
+            images,
+            SiftParameters(nfeatures=SiftDescriptorSet.FEATURES, reduction=sift_reduction, max_side=sift_max_side),
+            HsvHistogramBatch(reduction=histogram_reduction, max_side=histogram_max_side),
+            workers,
+        )
+        results1 = self._hist.run(images, reduction=histogram_reduction, max_side=histogram_max_side, workers=workers)
+        k1 = results1.k()
+        groups = results1.indices()
+
+        # Groups run in parallel with one worker each, or one after another with all workers.
+        parallel = workers > 1 and len(groups) > 1
+
+        def run_group(indices: List[int]) -> ndarray:
+            urls = [images[i] for i in indices]
+            return self._sift.run(urls, 1 if parallel else workers, reduction=sift_reduction, max_side=sift_max_side).label_array()
+
+        if parallel:
+            with ThreadPoolExecutor(workers) as pool:
+                results2 = list(pool.map(run_group, groups))
+        else:
+            results2 = list(map(run_group, groups))
+        cluster = full(len(images), -1)
+        for label1, (indices, labels2) in enumerate(zip(groups, results2)):
+            cluster[indices] = self.combine(label1, labels2.astype(int64), k1)
+        cluster = cluster.tolist()
         self.remove_empty_clusters(cluster)
         return ClusterResults(images, cluster)
 
@@ -119,9 +154,14 @@ class HybridCluster3(HybridCluster):
         saturation_bins: int = 256,
         value_bins: int = 256,
         bandwidth: Optional[float] = None,
+        workers: int = 1,
+        sift_reduction: ImageReduction = ImageReduction.FULL,
+        sift_max_side: int = 0,
+        histogram_reduction: ImageReduction = ImageReduction.FULL,
+        histogram_max_side: int = 0,
     ) -> ClusterResults:
-        results1 = SiftCluster2().run_cached(
-            images,
+        sift = SiftCluster2()
+        sift_args = dict(
             nfeatures=nfeatures,
             nOctaveLayers=nOctaveLayers,
             contrastThreshold=contrastThreshold,
@@ -134,19 +174,45 @@ class HybridCluster3(HybridCluster):
             convergence_iter=convergence_iter,
             affinity=affinity,
             descriptor_matcher=descriptor_matcher,
+            workers=workers,
+            reduction=sift_reduction,
+            max_side=sift_max_side,
         )
-        results2 = HistogramCluster().run_cached(
-            images,
+        histogram = HistogramCluster()
+        histogram_args = dict(
             hue_bins=hue_bins,
             saturation_bins=saturation_bins,
             value_bins=value_bins,
             bandwidth=bandwidth,
+            reduction=histogram_reduction,
+            max_side=histogram_max_side,
+            workers=workers,
+        )
+        # Stages with saved results do not need their features.
+        self.extract_features(
+            images,
+            None if sift.is_cached(images, **sift_args) else SiftParameters(
+                nfeatures,
+                nOctaveLayers,
+                contrastThreshold,
+                edgeThreshold,
+                sigma,
+                sift_reduction,
+                sift_max_side,
+            ),
+            None if histogram.is_cached(images, **histogram_args) else HsvHistogramBatch(
+                hue_bins,
+                saturation_bins,
+                value_bins,
+                histogram_reduction,
+                histogram_max_side,
+            ),
+            workers,
         )
-        labels1 = results1.labels()
-        labels2 = results2.labels()
+        results1 = sift.run_cached(images, **sift_args)
+        results2 = histogram.run_cached(images, **histogram_args)
         k1 = results1.k()
-        cluster = [self.combine(c1, c2, k1)
-                   for c1, c2 in zip(labels1, labels2)]
+        cluster = self.combine(results1.label_array(), results2.label_array().astype(int64), k1).tolist()
         self.remove_empty_clusters(cluster)
         return ClusterResults(images, cluster)
 
@@ -0,0 +1,286 @@
+from enum import Enum
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+from numpy import (concatenate, cumsum, einsum, float32, full, inf, isfinite,
+                   maximum, ndarray, partition, sqrt, where)
+
+from core.typing2 import number
+
+Descriptors = ndarray
+Pair = Tuple[int, int]
+
+
+def descriptor_distances(a: Descriptors, b: Descriptors) -> ndarray:
+    """
+    Returns the Euclidean distance between every descriptor in the first set and every descriptor in the second set.
+    Row i column j is the distance between a[i] and b[j].
+    Computed as one matrix multiplication from ||a||^2 + ||b||^2 - 2ab'.
+    Stored uint8 descriptors are converted to float32 here, so only the given blocks are copied.
+    """
+    a = a.astype(float32, copy=False)
+    b = b.astype(float32, copy=False)
+    aa = einsum('ij,ij->i', a, a)
+    bb = einsum('ij,ij->i', b, b)
+    d = aa[:, None] + bb[None, :] - 2 * a.dot(b.T)
+    return sqrt(maximum(d, 0, out=d), out=d)
+
+
+def segment_nearest_two(distances: ndarray, offsets: List[int]) -> Tuple[ndarray, ndarray]:
+    """
+    Returns the distance to the nearest and second nearest column of each row within each segment of columns.
+    Segment s is made of the columns from offsets[s] up to offsets[s + 1].
+    Missing neighbors in segments with fewer than two columns are infinitely far.
+    Segments are partitioned one at a time, so no temporary is larger than one segment.
+    """
+    rows = distances.shape[0]
+    segments = len(offsets) - 1
+    nearest = full((rows, segments), inf, distances.dtype)
+    second = full((rows, segments), inf, distances.dtype)
+    for s in range(segments):
+        segment = distances[:, offsets[s]:offsets[s + 1]]
+        if segment.shape[1] == 1:
+            nearest[:, s] = segment[:, 0]
+        elif segment.shape[1] > 1:
+            two = partition(segment, 1, axis=1)
+            nearest[:, s] = two[:, 0]
+            second[:, s] = two[:, 1]
+    return nearest, second
+
+
+class SimilarityMetric(Enum):
+    INVERSE_DISTANCE = 'inverse_distance'
+    COUNT = 'count'
+
+
+class DescriptorMatcher(Enum):
+    FLANNBASED = 'flann_based'
+    BRUTEFORCE = 'brute_force'
+    NUMPY = 'numpy'
+
+
+class KnnRatioMatcher(object):
+    """
+    Measures how similar two images are by matching their descriptors with k nearest neighbors.
+    Filters out false matches by Lowe's ratio test.
+    The NumPy matcher finds the two nearest neighbors from a distance matrix and scores every pair with array operations instead of DMatch objects.
+    """
+
+    # Upper limit of train descriptors stacked into one matrix multiplication.
+    BATCH_COLUMNS = 32768
+    # Upper limit of query descriptors times train descriptors in one distance matrix.
+    BATCH_ELEMENTS = 2 ** 23
+
+    def __init__(
+        self,
+        descriptor_matcher: DescriptorMatcher,
+        ratio: float,
+        similarity_metric: SimilarityMetric,
+        nfeatures: int,
+    ) -> None:
+        self.descriptor_matcher = descriptor_matcher
+        self.ratio = ratio
+        self.similarity_metric = similarity_metric
+        self.nfeatures = nfeatures
+        self._matcher = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_matcher'] = None
+        return state
+
+    def _create_matcher(self) -> cv2.DescriptorMatcher:
+        if self.descriptor_matcher == DescriptorMatcher.FLANNBASED:
+            return cv2.FlannBasedMatcher_create()
+        return cv2.BFMatcher_create()
+
+    def key(self) -> str:
+        """
+        Returns a string that identifies the settings that affect the similarity.
+        """
+        return '%s/%r/%s' % (self.descriptor_matcher.value, self.ratio, self.similarity_metric.value)
+
+    def identity(self) -> number:
+        """
+        Returns the similarity of an image to itself.
+        """
+        if self.similarity_metric == SimilarityMetric.INVERSE_DISTANCE:
+            return 1
+        elif self.similarity_metric == SimilarityMetric.COUNT:
+            return self.nfeatures
+        return 0
+
+    def good_matches(self, a: Descriptors, b: Descriptors) -> List[cv2.DMatch]:
+        """
+        Returns the matches that pass the ratio test.
+        """
+        if self._matcher is None:
+            self._matcher = self._create_matcher()
+        # OpenCV only matches float32 descriptors.
+        matches = self._matcher.knnMatch(
+            queryDescriptors=a.astype(float32, copy=False),
+            trainDescriptors=b.astype(float32, copy=False),
+            k=2,
+        )
+        good = []
+        for m, n in matches:
+            if m.distance < self.ratio * n.distance:
+                good.append(m)
+        return good
+
+    def _score(self, nearest: ndarray, second: ndarray) -> List[number]:
+        """
+        Applies the ratio test and the similarity metric to the two nearest neighbor distances of each query descriptor (rows) in each image (columns).
+        """
+        good = (nearest < self.ratio * second) & isfinite(second)
+        count = good.sum(axis=0)
+        if self.similarity_metric == SimilarityMetric.INVERSE_DISTANCE:
+            inverse_distance = where(good, 1 - nearest, 0).sum(axis=0, dtype=float)
+            return [float(i / c) if c > 0 else 0 for i, c in zip(inverse_distance, count)]
+        elif self.similarity_metric == SimilarityMetric.COUNT:
+            return count.tolist()
+        return [0] * len(count)
+
+    def compute_many(self, a: Descriptors, bs: List[Descriptors]) -> List[number]:
+        """
+        Returns how similar one image is to each of many images.
+        The NumPy matcher stacks the train descriptors of many images into one matrix multiplication.
+        Query descriptors are taken in chunks of rows so each distance matrix stays under BATCH_ELEMENTS.
+        """
+        if self.descriptor_matcher != DescriptorMatcher.NUMPY:
+            return [self.compute(a, b) for b in bs]
+        results = list()
+        start = 0
+        while start < len(bs):
+            stop = start + 1
+            columns = len(bs[start])
+            while stop < len(bs) and columns + len(bs[stop]) <= self.BATCH_COLUMNS:
+                columns += len(bs[stop])
+                stop += 1
+            batch = bs[start:stop]
+            offsets = concatenate(([0], cumsum([len(b) for b in batch])))
+            stacked = concatenate(batch).astype(float32, copy=False)
+            step = max(1, self.BATCH_ELEMENTS // max(1, columns))
+            nearest = list()
+            second = list()
+            for row in range(0, max(1, len(a)), step):
+                n, s = segment_nearest_two(descriptor_distances(a[row:row + step], stacked), offsets)
+                nearest.append(n)
+                second.append(s)
+            results.extend(self._score(concatenate(nearest), concatenate(second)))
+            start = stop
+        return results
+
+    def compute(self, a: Descriptors, b: Descriptors) -> number:
+        """
+        Returns a measure of how similar two images (sets of descriptors) are.
+        """
+        if self.descriptor_matcher == DescriptorMatcher.NUMPY:
+            return self.compute_many(a, [b])[0]
+        good = self.good_matches(a, b)
+        if self.similarity_metric == SimilarityMetric.INVERSE_DISTANCE:
+            inverse_distance = 0
+            for k in good:
+                inverse_distance += 1 - k.distance
+            if len(good) > 0:
+                return inverse_distance / len(good)
+        elif self.similarity_metric == SimilarityMetric.COUNT:
+            return len(good)
+        return 0
+
+
+_WORKER: Dict[str, Any] = dict()
+
+
+def _match(descriptors: List[Descriptors], pairs: List[Pair], compute: Callable, compute_many: Optional[Callable]) -> List[Any]:
+    """
+    Computes the similarity of a chunk of pairs.
+    Consecutive pairs with the same query are batched through compute_many when it is given.
+    """
+    if compute_many is None:
+        return [compute(descriptors[i], descriptors[j]) for i, j in pairs]
+    results = list()
+    start = 0
+    while start < len(pairs):
+        i = pairs[start][0]
+        stop = start
+        while stop < len(pairs) and pairs[stop][0] == i:
+            stop += 1
+        results.extend(compute_many(descriptors[i], [descriptors[j] for _, j in pairs[start:stop]]))
+        start = stop
+    return results
+
+
+def _attach(name: str, shape: Tuple[int, ...], dtype: str, offsets: List[int], compute: Callable, compute_many: Optional[Callable]) -> None:
+    """
+    Initializes a worker process with views of the descriptors in shared memory.
+    """
+    shm = SharedMemory(name=name)
+    stacked = ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _WORKER['shm'] = shm
+    _WORKER['descriptors'] = [stacked[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+    _WORKER['compute'] = compute
+    _WORKER['compute_many'] = compute_many
+
+
+def _match_chunk(pairs: List[Pair]) -> List[Any]:
+    """
+    Computes the similarity of a chunk of pairs inside a worker process.
+    """
+    return _match(_WORKER['descriptors'], pairs, _WORKER['compute'], _WORKER['compute_many'])
+
+
+class MatchingEngine(object):
+    """
+    Computes the similarity of many pairs of images.
+    With more than one worker, pairs are scheduled in chunks across a pool of processes.
+    The descriptors are copied once into shared memory instead of being pickled with every task.
+    Each pair is computed by the same function on the same values, so the results are identical to the serial path.
+    """
+
+    def __init__(self, workers: int = 1, chunksize: int = 0) -> None:
+        self._workers = max(1, workers)
+        self._chunksize = chunksize
+
+    def _chunks(self, pairs: List[Pair]) -> List[List[Pair]]:
+        chunksize = self._chunksize
+        if chunksize <= 0:
+            # Independent of the number of workers so batches are the same as in the serial path.
+            chunksize = min(256, max(1, len(pairs) // 64))
+        return [pairs[i:i + chunksize] for i in range(0, len(pairs), chunksize)]
+
+    def run(
+        self,
+        descriptors: List[Descriptors],
+        pairs: List[Pair],
+        compute: Callable[[Descriptors, Descriptors], Any],
+        compute_many: Optional[Callable[[Descriptors, List[Descriptors]], List[Any]]] = None,
+    ) -> List[Any]:
+        """
+        Returns compute(descriptors[i], descriptors[j]) for each pair (i, j) in order.
+        If compute_many is given, each run of pairs that share the same query is computed by one call to it.
+        """
+        if self._workers == 1 or len(pairs) < 2:
+            results = list()
+            for chunk in self._chunks(pairs):
+                results.extend(_match(descriptors, chunk, compute, compute_many))
+                print("SIFT SIMILARITY: %i / %i" % (len(results), len(pairs)))
+            return results
+        stacked = concatenate(descriptors)
+        offsets = [0] + cumsum([len(d) for d in descriptors]).tolist()
+        shm = SharedMemory(create=True, size=max(1, stacked.nbytes))
+        try:
+            ndarray(stacked.shape, dtype=stacked.dtype, buffer=shm.buf)[:] = stacked
+            results = list()
+            initargs = (shm.name, stacked.shape, stacked.dtype.str, offsets, compute, compute_many)
+            del stacked
+            with Pool(self._workers, _attach, initargs) as pool:
+                for chunk in pool.imap(_match_chunk, self._chunks(pairs)):
+                    results.extend(chunk)
+                    print("SIFT SIMILARITY: %i / %i" % (len(results), len(pairs)))
+        finally:
+            shm.close()
+            shm.unlink()
+        return results
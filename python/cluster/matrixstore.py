@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from os import listdir, makedirs, replace
+from os.path import getmtime, getsize, isdir, isfile, join
+from time import time
+from typing import Any, Dict, List, Union
+
+from numpy import float32, load, ndarray, save
+from scipy.sparse import csr_matrix, load_npz, save_npz, vstack
+
+from core.typing2 import Url
+
+
+class SimilarityMatrixStore(object):
+    """
+    A similarity matrix saved as binary files so it is reused across clustering runs.
+    Dense matrices are one NumPy file that is memory mapped.
+    Sparse matrices are split into blocks of rows that are compressed separately.
+    Either format reads a range of rows without loading the rest of the matrix.
+    An index keeps the size and last access time of every matrix.
+    When the matrices are larger than the limit, the least recently used are deleted.
+    """
+
+    DIRECTORY = 'cache/similarity'
+    # Number of rows in each compressed block of a sparse matrix.
+    BLOCK = 1024
+    # Largest number of rows sent to a client at once.
+    PAGE = 256
+    MAX_BYTES = 4 * 2 ** 30
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """
+        Returns a key from strings that identify the images and the settings of a matrix.
+        """
+        return hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def is_key(key: Any) -> bool:
+        """
+        Returns true if a string has the form of a key, which keeps keys from clients inside the directory.
+        """
+        return isinstance(key, str) and re.fullmatch('[0-9a-f]{32}', key) is not None
+
+    @classmethod
+    def all(cls) -> List['SimilarityMatrixStore']:
+        """
+        Returns every saved matrix.
+        """
+        if not isdir(cls.DIRECTORY):
+            return list()
+        stores = [cls(key) for key in sorted(listdir(cls.DIRECTORY)) if cls.is_key(key)]
+        return [store for store in stores if store.exists()]
+
+    @classmethod
+    def _index(cls) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the size and last access time of each matrix.
+        The index is rebuilt from the directory if it is missing or unreadable.
+        """
+        url = join(cls.DIRECTORY, 'index.json')
+        if isfile(url):
+            try:
+                with open(url) as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+        return {store.key: {'size': store._size(), 'atime': getmtime(store._url('meta.json'))} for store in cls.all()}
+
+    @classmethod
+    def _save_index(cls, index: Dict[str, Dict[str, float]]) -> None:
+        url = join(cls.DIRECTORY, 'index.json')
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(index, f)
+        replace(temp, url)
+
+    def _size(self) -> int:
+        directory = self._url('')
+        return sum(getsize(join(directory, name)) for name in listdir(directory))
+
+    def _touch(self) -> None:
+        """
+        Records that the matrix was used now.
+        """
+        index = self._index()
+        index[self.key] = {'size': index.get(self.key, {}).get('size') or self._size(), 'atime': time()}
+        self._save_index(index)
+
+    def _delete(self) -> None:
+        # The metadata goes first so the matrix stops being valid before its rows disappear.
+        if isfile(self._url('meta.json')):
+            os.remove(self._url('meta.json'))
+        shutil.rmtree(self._url(''), ignore_errors=True)
+
+    def _evict(self, index: Dict[str, Dict[str, float]], max_bytes: int) -> None:
+        """
+        Deletes the least recently used matrices until the matrices fit in the limit.
+        The matrix of this store is always kept even if it alone is over the limit.
+        """
+        total = sum(e['size'] for e in index.values())
+        for key in sorted(index, key=lambda k: index[k]['atime']):
+            if total <= max_bytes:
+                break
+            if key == self.key:
+                continue
+            print('EVICTING: %s' % join(self.DIRECTORY, key))
+            total -= index[key]['size']
+            type(self)(key)._delete()
+            del index[key]
+
+    def _url(self, name: str) -> Url:
+        return join(self.DIRECTORY, self.key, name)
+
+    def _block_url(self, block: int) -> Url:
+        return self._url('%d.npz' % block)
+
+    def exists(self) -> bool:
+        """
+        Returns true if the matrix was completely saved.
+        """
+        return isfile(self._url('meta.json'))
+
+    def meta(self) -> Dict[str, Any]:
+        """
+        Returns the name, images, shape, data type, and format of the matrix.
+        """
+        with open(self._url('meta.json')) as f:
+            return json.load(f)
+
+    def _save_meta(self, meta: Dict[str, Any]) -> None:
+        # Written last and atomically so a partial save is never mistaken for a complete one.
+        url = self._url('meta.json')
+        tmp = '%s.tmp' % url
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        replace(tmp, url)
+
+    def save(self, matrix: Union[ndarray, csr_matrix], name: str, images: List[Url], max_bytes: int = MAX_BYTES) -> None:
+        """
+        Saves a dense or sparse matrix with the name of the similarity and the images of its rows.
+        Then the least recently used matrices are deleted until the saved ones fit in the limit.
+        """
+        makedirs(self._url(''), exist_ok=True)
+        meta = {
+            'name': name,
+            'images': images,
+            'shape': list(matrix.shape),
+            'dtype': str(matrix.dtype),
+        }
+        if isinstance(matrix, csr_matrix):
+            print('SAVING: %s' % self._url(''))
+            meta['format'] = 'sparse'
+            meta['block'] = self.BLOCK
+            for block, start in enumerate(range(0, matrix.shape[0], self.BLOCK)):
+                save_npz(self._block_url(block), matrix[start:start + self.BLOCK], compressed=True)
+        else:
+            url = self._url('matrix.npy')
+            print('SAVING: %s' % url)
+            meta['format'] = 'dense'
+            with open('%s.tmp' % url, 'wb') as f:
+                save(f, matrix)
+            replace('%s.tmp' % url, url)
+        self._save_meta(meta)
+        index = self._index()
+        index[self.key] = {'size': self._size(), 'atime': time()}
+        self._evict(index, max_bytes)
+        self._save_index(index)
+
+    def load(self) -> Union[ndarray, csr_matrix]:
+        """
+        Returns the whole matrix.
+        A dense matrix is a read-only memory map.
+        """
+        meta = self.meta()
+        return self.rows(0, meta['shape'][0])
+
+    def rows(self, start: int, stop: int) -> Union[ndarray, csr_matrix]:
+        """
+        Returns the rows from start up to stop.
+        Only the blocks that hold those rows are read.
+        """
+        meta = self.meta()
+        self._touch()
+        start = max(0, start)
+        stop = min(stop, meta['shape'][0])
+        if meta['format'] == 'dense':
+            url = self._url('matrix.npy')
+            print('LOADING: %s [%i:%i]' % (url, start, stop))
+            return load(url, mmap_mode='r')[start:stop]
+        print('LOADING: %s [%i:%i]' % (self._url(''), start, stop))
+        block = meta['block']
+        if stop <= start:
+            return csr_matrix((0, meta['shape'][1]), dtype=float32)
+        first = start // block
+        last = (stop - 1) // block
+        blocks = [load_npz(self._block_url(b)) for b in range(first, last + 1)]
+        offset = first * block
+        return vstack(blocks, format='csr')[start - offset:stop - offset]
@@ -0,0 +1,125 @@
+import sqlite3
+from typing import Dict, Iterator, List, Tuple
+
+from numpy import float64, ndarray, triu, zeros
+from numpy.typing import DTypeLike
+
+from cluster.matching import Descriptors, KnnRatioMatcher, MatchingEngine
+from core.jl import mkdirname
+from core.typing2 import Url
+
+Matrix = ndarray
+
+
+class PairSimilarityCache(object):
+    """
+    Persistent similarity scores between pairs of images.
+    Pairs are keyed by the content addresses of both descriptor sets and the matcher settings.
+    Each unordered pair is stored once with the smaller content address as the query.
+    """
+
+    URL = 'cache/pairs.sqlite'
+    # Rows of the similarity matrix held in memory at once.
+    BLOCK = 1024
+
+    def __init__(self, matcher: KnnRatioMatcher, url: Url = URL) -> None:
+        mkdirname(url, False)
+        self._matcher = matcher
+        self._db = sqlite3.connect(url)
+        self._db.execute('CREATE TABLE IF NOT EXISTS matcher (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS similarity (matcher INTEGER, a BLOB, b BLOB, value REAL, PRIMARY KEY (matcher, a, b)) WITHOUT ROWID')
+        # Rows of the matrix look up pairs from both sides.
+        self._db.execute('CREATE INDEX IF NOT EXISTS similarity_b ON similarity (matcher, b)')
+        self._db.execute('INSERT OR IGNORE INTO matcher (name) VALUES (?)', (matcher.key(),))
+        self._db.commit()
+        self._id = self._db.execute('SELECT id FROM matcher WHERE name = ?', (matcher.key(),)).fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+    def lookup(self, key: str) -> List[Tuple[str, float]]:
+        """
+        Returns the content addresses that have a cached similarity with a content address, along with the similarities.
+        """
+        blob = bytes.fromhex(key)
+        rows = self._db.execute('SELECT b, value FROM similarity WHERE matcher = ? AND a = ?', (self._id, blob)).fetchall()
+        rows += self._db.execute('SELECT a, value FROM similarity WHERE matcher = ? AND b = ?', (self._id, blob)).fetchall()
+        return [(other.hex(), value) for other, value in rows]
+
+    def insert(self, values: List[Tuple[str, str, float]]) -> None:
+        """
+        Saves the similarities of pairs of content addresses.
+        """
+        self._db.executemany(
+            'INSERT OR REPLACE INTO similarity (matcher, a, b, value) VALUES (?, ?, ?, ?)',
+            [(self._id, bytes.fromhex(a), bytes.fromhex(b), value) for a, b, value in values],
+        )
+        self._db.commit()
+
+    @staticmethod
+    def _canonical(keys: List[str], i: int, j: int) -> Tuple[int, int]:
+        """
+        Orders a pair of indices so the smaller content address is the query.
+        """
+        if keys[j] < keys[i]:
+            return j, i
+        return i, j
+
+    def rows(
+        self,
+        keys: List[str],
+        descriptors: List[Descriptors],
+        engine: MatchingEngine,
+        dtype: DTypeLike = float64,
+        block: int = BLOCK,
+    ) -> Iterator[ndarray]:
+        """
+        Yields the similarity matrix of a list of images in consecutive blocks of rows.
+        Only pairs that are not cached are matched, so adding images only costs their rows and columns.
+        The pairs matched for a block are saved before the next block, which finds them in the cache.
+        """
+        num = len(keys)
+        columns: Dict[str, List[int]] = dict()
+        for j, key in enumerate(keys):
+            columns.setdefault(key, list()).append(j)
+        cached = 0
+        matched = 0
+        for start in range(0, num, block):
+            stop = min(start + block, num)
+            rows = zeros((stop - start, num), dtype)
+            known = zeros((stop - start, num), bool)
+            for i in range(start, stop):
+                for other, value in self.lookup(keys[i]):
+                    for j in columns.get(other, ()):
+                        rows[i - start, j] = value
+                        known[i - start, j] = True
+                rows[i - start, i] = self._matcher.identity()
+                known[i - start, i] = True
+            # Each pair is counted in the row of its first image.
+            cached += int(triu(known, start + 1).sum())
+            todo = dict()
+            for i, j in zip(*(~known).nonzero()):
+                q, t = self._canonical(keys, start + i, j)
+                todo.setdefault((keys[q], keys[t]), (q, t))
+            todo = sorted(todo.items(), key=lambda x: x[1])
+            values = engine.run(descriptors, [pair for _, pair in todo], self._matcher.compute, self._matcher.compute_many)
+            computed = dict(zip([key for key, _ in todo], values))
+            matched += len(computed)
+            for i, j in zip(*(~known).nonzero()):
+                q, t = self._canonical(keys, start + i, j)
+                rows[i, j] = computed[(keys[q], keys[t])]
+            self.insert([(a, b, value) for (a, b), value in computed.items()])
+            yield rows
+        print('SIFT SIMILARITY: %i cached, %i new' % (cached, matched))
+
+    def matrix(self, keys: List[str], descriptors: List[Descriptors], engine: MatchingEngine, dtype: DTypeLike = float64) -> Matrix:
+        """
+        Returns the dense similarity matrix of a list of images.
+        """
+        num = len(keys)
+        matrix = zeros((num, num), dtype)
+        start = 0
+        for rows in self.rows(keys, descriptors, engine, dtype):
+            matrix[start:start + len(rows)] = rows
+            start += len(rows)
+        return matrix
@@ -1,17 +1,27 @@
 from abc import ABC, abstractmethod
 from enum import Enum
 from json import dump
-from typing import Any, Dict, List, Union
-import itertools
+from os.path import getsize
+from typing import Any, Dict, List, Optional, Tuple, Union
 import cv2
 from core.cluster import ClusterRegistry, ClusterResults, ClusterStrategy
-from core.jl import npsave, read_image
+from core.jl import ImageReduction, npsave
 from core.typing2 import Url, number
-from numpy import amax, apply_along_axis, ndarray, set_printoptions, zeros
+from numpy import (amax, array, count_nonzero, float32, float64, ndarray,
+                   partition, zeros)
+from numpy.typing import DTypeLike
+from scipy.sparse import csr_matrix
 from sklearn.cluster import AffinityPropagation
 from sklearn.preprocessing import normalize
 
-set_printoptions(threshold=10000000000)
+from cluster.affinity import SparseAffinityPropagation, top_k, top_k_rows
+from cluster.descriptorstore import SiftDescriptorStore, SiftParameters
+from cluster.matching import (DescriptorMatcher, KnnRatioMatcher,
+                              MatchingEngine, SimilarityMetric,
+                              descriptor_distances)
+from cluster.matrixstore import SimilarityMatrixStore
+from cluster.paircache import PairSimilarityCache
+
 Descriptors = ndarray
 Matrix = ndarray
 
@@ -29,6 +39,18 @@ class Similarity(ABC):
         """
         pass
 
+    def identity(self, a: Descriptors) -> number:
+        """
+        Returns the similarity of an image to itself.
+        """
+        return self.compute(a, a)
+
+    def compute_pair(self, a: Descriptors, b: Descriptors) -> Tuple[number, number]:
+        """
+        Returns how similar the first image is to the second and how similar the second image is to the first.
+        """
+        return self.compute(a, b), self.compute(b, a)
+
 
 class Similarity1(Similarity):
     """
@@ -66,6 +88,31 @@ class Similarity1(Similarity):
         x = self.ratio_test(m)
         return len(x)
 
+    @staticmethod
+    def directional(distances: ndarray) -> number:
+        """
+        Returns the number of true matches from a query set (rows) to a train set (columns) of a distance matrix.
+        """
+        if distances.shape[1] < 2:
+            return 0
+        nearest = partition(distances, 1, axis=1)
+        return int(count_nonzero(nearest[:, 0] < .75 * nearest[:, 1]))
+
+    def identity(self, a: Descriptors) -> number:
+        """
+        Returns the similarity of an image to itself.
+        Every descriptor is its own nearest neighbor at distance zero.
+        """
+        return len(a)
+
+    def compute_pair(self, a: Descriptors, b: Descriptors) -> Tuple[number, number]:
+        """
+        Returns how similar the first image is to the second and how similar the second image is to the first.
+        Both directions are derived from a single distance matrix.
+        """
+        distances = descriptor_distances(a, b)
+        return self.directional(distances), self.directional(distances.T)
+
 
 class Similarity2(Similarity):
     """
@@ -103,6 +150,30 @@ class Similarity2(Similarity):
         x = self.ratio_test(m)
         return len(x)
 
+    @staticmethod
+    def directional(distances: ndarray) -> number:
+        """
+        Returns the number of true matches from a query set (rows) to a train set (columns) of a distance matrix.
+        """
+        if distances.size == 0:
+            return 0
+        return int(count_nonzero(distances.min(axis=1) <= .6))
+
+    def identity(self, a: Descriptors) -> number:
+        """
+        Returns the similarity of an image to itself.
+        Every descriptor is its own best match at distance zero.
+        """
+        return len(a)
+
+    def compute_pair(self, a: Descriptors, b: Descriptors) -> Tuple[number, number]:
+        """
+        Returns how similar the first image is to the second and how similar the second image is to the first.
+        Both directions are derived from a single distance matrix.
+        """
+        distances = descriptor_distances(a, b)
+        return self.directional(distances), self.directional(distances.T)
+
 
 class Similarity3(Similarity2):
     """
@@ -122,52 +193,110 @@ class Similarity3(Similarity2):
                 sim = sim + closeness
         return sim
 
+    @staticmethod
+    def directional(distances: ndarray) -> number:
+        """
+        Returns the sum of the closeness of true matches from a query set (rows) to a train set (columns) of a distance matrix.
+        """
+        if distances.size == 0:
+            return 0
+        nearest = distances.min(axis=1)
+        return float((1 - nearest[nearest <= .75]).sum())
+
 
 class SimilarityMatrix(object):
     """
     A square array.
     Each XY entry is a numerical value of how similar X is to Y.
+    Large matrices are single precision by default to halve their memory.
     """
 
-    def __init__(self, descriptors: List[Descriptors], algorithm: Similarity) -> None:
+    # Smallest number of images that gets a single precision matrix by default.
+    FLOAT32_SIZE = 2048
+
+    def __init__(
+        self,
+        descriptors: List[Descriptors],
+        algorithm: Similarity,
+        engine: Optional[MatchingEngine] = None,
+        dtype: Optional[DTypeLike] = None,
+    ) -> None:
+        if engine is None:
+            engine = MatchingEngine()
         num = len(descriptors)
-        matrix = self.empty_matrix(num)
-        for x, d1 in enumerate(descriptors):
-            for y, d2 in enumerate(descriptors):
-                matrix[x, y] = algorithm.compute(d1, d2)
+        if dtype is None:
+            dtype = float32 if num >= self.FLOAT32_SIZE else float64
+        matrix = self.empty_matrix(num, dtype)
+        print('SIMILARITY MATRIX: %i x %i %s, %s' % (num, num, matrix.dtype, self.format_bytes(matrix.nbytes)))
+        for x, d in enumerate(descriptors):
+            matrix[x, x] = algorithm.identity(d)
+        pairs = [(x, y) for x in range(num) for y in range(x + 1, num)]
+        for (x, y), (xy, yx) in zip(pairs, engine.run(descriptors, pairs, algorithm.compute_pair)):
+            matrix[x, y] = xy
+            matrix[y, x] = yx
         self.matrix = matrix
         return
 
+    @classmethod
+    def from_array(cls, matrix: Matrix) -> 'SimilarityMatrix':
+        """
+        Returns a similarity matrix of values that were already computed.
+        """
+        sm = cls.__new__(cls)
+        sm.matrix = matrix
+        return sm
+
     @staticmethod
-    def empty_matrix(size: int) -> Matrix:
+    def empty_matrix(size: int, dtype: DTypeLike = float64) -> Matrix:
         """
         Returns a square matrix filled with zeros.
         """
         dim = (size, size)
-        return zeros(dim)
+        return zeros(dim, dtype)
+
+    @staticmethod
+    def format_bytes(size: int) -> str:
+        """
+        Returns a number of bytes in mebibytes.
+        """
+        return '%.1f MiB' % (size / 2 ** 20)
+
+    def nbytes(self) -> int:
+        """
+        Returns the memory used by the matrix.
+        """
+        return self.matrix.nbytes
 
     def save_as_json(self, url: Url) -> None:
         """
         Saves the similarity matrix as a JSON file.
         """
+        print('SAVING: %s' % url)
         with open(url, 'w') as f:
             dump(self.matrix.tolist(), f)
+        print('SAVED: %s (%s in memory, %s on disk)' % (url, self.format_bytes(self.nbytes()), self.format_bytes(getsize(url))))
         return
 
     @staticmethod
     def scale_row(row: ndarray) -> ndarray:
         """
         Scales a 1D array between 0 and 1.
+        A row of zeros stays zeros.
         """
         max_ = amax(row)
+        if max_ == 0:
+            return row.copy()
         row2 = row / max_
         return row2
 
     def scale(self):
         """
-        Scales the similarity matrix row by row.
+        Scales the similarity matrix row by row in place.
+        Rows whose largest value is zero are left as they are.
         """
-        self.matrix = apply_along_axis(self.scale_row, 1, self.matrix)
+        max_ = amax(self.matrix, axis=1, keepdims=True)
+        max_[max_ == 0] = 1
+        self.matrix /= max_
 
 
 class SiftDescriptorSet(object):
@@ -176,20 +305,25 @@ class SiftDescriptorSet(object):
     More features helps distinguishing images but adds more bad descriptors.
     """
 
-    def __init__(self, images: List[Url], features: int = 300):
-        sift = cv2.xfeatures2d.SIFT_create(nfeatures=features)
-        a = list()
-        for url in images:
-            image = read_image(url)
-            _, descriptors = sift.detectAndCompute(image=image, mask=None)
-            a.append(descriptors)
-        self.descriptors = a
+    FEATURES = 300
+
+    def __init__(
+        self,
+        images: List[Url],
+        features: int = FEATURES,
+        workers: int = 1,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+    ):
+        store = SiftDescriptorStore(SiftParameters(nfeatures=features, reduction=reduction, max_side=max_side))
+        self.descriptors = store.get_all(images, workers)
+        self.keys = store.keys(images)
 
     def unit_normalize(self) -> None:
         """
         Scales input vectors individually to unit norm (vector length).
         """
-        self.descriptors = list(map(normalize, self.descriptors))
+        self.descriptors = [normalize(d.astype(float32)) for d in self.descriptors]
 
     def save(self, url: Url) -> None:
         """
@@ -198,6 +332,47 @@ class SiftDescriptorSet(object):
         npsave(url, self.descriptors)
 
 
+class AffinityPropagationAffinity(Enum):
+    EUCLIDEAN = 'euclidean'
+    PRECOMPUTED = 'precomputed'
+    SPARSE = 'sparse'
+
+
+def affinity_propagation(
+    matrix: Union[ndarray, csr_matrix],
+    affinity: AffinityPropagationAffinity,
+    neighbors: int = 10,
+    damping: float = 0.5,
+    max_iter: int = 200,
+    convergence_iter: int = 15,
+    preference: Optional[float] = None,
+) -> List[int]:
+    """
+    Clusters the rows of a similarity matrix by affinity propagation.
+    The sparse affinity only keeps the most similar neighbors of each row, so clustering costs memory and time per edge instead of per pair.
+    A sparse matrix is taken as those neighbors already.
+    Without a preference, the dense affinities use the median similarity and the sparse affinity uses the smallest kept similarity.
+    """
+    if affinity == AffinityPropagationAffinity.SPARSE:
+        graph = matrix if isinstance(matrix, csr_matrix) else top_k(matrix, neighbors)
+        print('CLUSTER: SparseAffinityPropagation (%i edges)' % graph.nnz)
+        return SparseAffinityPropagation(
+            damping=damping,
+            max_iter=max_iter,
+            convergence_iter=convergence_iter,
+            preference=preference,
+        ).fit_predict(graph).tolist()
+    print('CLUSTER: AffinityPropagation')
+    return AffinityPropagation(
+        damping=damping,
+        max_iter=max_iter,
+        convergence_iter=convergence_iter,
+        affinity=affinity.value,
+        preference=preference,
+        random_state=0,
+    ).fit_predict(matrix).tolist()
+
+
 class SiftCluster(ClusterStrategy):
     """
     Clusters images from SIFT descriptors.
@@ -206,40 +381,42 @@ class SiftCluster(ClusterStrategy):
     def __init__(self, similarity: Similarity):
         self._similarity: Similarity = similarity
 
-    def run(self, images: List[Url]) -> ClusterResults:
+    def run(
+        self,
+        images: List[Url],
+        workers: int = 1,
+        affinity: AffinityPropagationAffinity = AffinityPropagationAffinity.EUCLIDEAN,
+        neighbors: int = 10,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+        preference: Optional[float] = None,
+    ) -> ClusterResults:
         """
         Creates descriptors of images.
         Groups images together by how similar their descriptors are.
         Returns a cluster ID for each set of descriptors.
         """
+        if not isinstance(affinity, AffinityPropagationAffinity):
+            affinity = AffinityPropagationAffinity(affinity)
         print("Creating descriptors from images....")
-        sds = SiftDescriptorSet(images)
+        sds = SiftDescriptorSet(images, workers=workers, reduction=reduction, max_side=max_side)
         print('Normalizing descriptors to unit vectors....')
         sds.unit_normalize()
         print('Similarity matrix....')
-        sm = SimilarityMatrix(sds.descriptors, self._similarity)
+        name = type(self._similarity).__name__
+        matrix_store = SimilarityMatrixStore(SimilarityMatrixStore.make_key(name, *sds.keys))
+        if matrix_store.exists():
+            sm = SimilarityMatrix.from_array(array(matrix_store.load()))
+        else:
+            sm = SimilarityMatrix(sds.descriptors, self._similarity, MatchingEngine(workers))
+            matrix_store.save(sm.matrix, name, images)
         print('Scaling each row of the similarity matrix....')
         sm.scale()
         print('Clustering by affinity propagation....')
-        cluster = AffinityPropagation(random_state=0).fit_predict(sm.matrix).tolist()
+        cluster = affinity_propagation(sm.matrix, affinity, neighbors, preference=preference)
         return ClusterResults(images, cluster)
 
 
-class SimilarityMetric(Enum):
-    INVERSE_DISTANCE = 'inverse_distance'
-    COUNT = 'count'
-
-
-class AffinityPropagationAffinity(Enum):
-    EUCLIDEAN = 'euclidean'
-    PRECOMPUTED = 'precomputed'
-
-
-class DescriptorMatcher(Enum):
-    FLANNBASED = 'flann_based'
-    BRUTEFORCE = 'brute_force'
-
-
 class SiftCluster2(ClusterStrategy):
     def run(
         self,
@@ -256,6 +433,11 @@ class SiftCluster2(ClusterStrategy):
         convergence_iter: int = 15,
         affinity: AffinityPropagationAffinity = AffinityPropagationAffinity.EUCLIDEAN,
         descriptor_matcher: DescriptorMatcher = DescriptorMatcher.FLANNBASED,
+        workers: int = 1,
+        neighbors: int = 10,
+        reduction: ImageReduction = ImageReduction.FULL,
+        max_side: int = 0,
+        preference: Optional[float] = None,
     ) -> ClusterResults:
         if not isinstance(similarity_metric, SimilarityMetric):
             similarity_metric = SimilarityMetric(similarity_metric)
@@ -263,54 +445,42 @@ class SiftCluster2(ClusterStrategy):
             affinity = AffinityPropagationAffinity(affinity)
         if not isinstance(descriptor_matcher, DescriptorMatcher):
             descriptor_matcher = DescriptorMatcher(descriptor_matcher)
-        list_of_images = list()
-        matrix = SimilarityMatrix.empty_matrix(len(images))
-        for url in images:
-            print("SIFT DESCRIPTORS: %s" % url)
-            keypoints, descriptors = cv2.xfeatures2d.SIFT_create(
-                nfeatures,
-                nOctaveLayers,
-                contrastThreshold,
-                edgeThreshold,
-                sigma,
-            ).detectAndCompute(image=read_image(url), mask=None)
-            list_of_images.append(descriptors)
-        combo = list(itertools.combinations_with_replacement(range(len(list_of_images)), 2))
-        if descriptor_matcher == DescriptorMatcher.FLANNBASED:
-            matcher = cv2.FlannBasedMatcher_create()
+        store = SiftDescriptorStore(SiftParameters(
+            nfeatures,
+            nOctaveLayers,
+            contrastThreshold,
+            edgeThreshold,
+            sigma,
+            reduction,
+            max_side,
+        ))
+        matcher = KnnRatioMatcher(descriptor_matcher, ratio, similarity_metric, nfeatures)
+        key = SimilarityMatrixStore.make_key(matcher.key(), *store.keys(images))
+        matrix_store = SimilarityMatrixStore(key)
+        # Older graphs kept only positive similarities, so the rule is part of the key.
+        graph_store = SimilarityMatrixStore(SimilarityMatrixStore.make_key(key, 'top %i matched' % neighbors))
+        sparse = affinity == AffinityPropagationAffinity.SPARSE
+        if sparse and graph_store.exists():
+            matrix = graph_store.load()
+        elif matrix_store.exists():
+            matrix = matrix_store.load()
         else:
-            matcher = cv2.BFMatcher_create()
-        for idx, (i, j) in enumerate(combo):
-            print("SIFT SIMILARITY: ( %i , %i ) %i / %i" % (i, j, idx, len(combo)))
-            if i != j:
-                matches = matcher.knnMatch(queryDescriptors=list_of_images[i], trainDescriptors=list_of_images[j], k=2)
-                good = []
-                for m, n in matches:
-                    if m.distance < ratio * n.distance:
-                        good.append(m)
-                if similarity_metric == SimilarityMetric.INVERSE_DISTANCE:
-                    inverse_distance = 0
-                    for k in good:
-                        inverse_distance += 1 - k.distance
-                    if len(good) > 0:
-                        matrix[i][j] = inverse_distance / len(good)
-                        matrix[j][i] = inverse_distance / len(good)
-                elif similarity_metric == SimilarityMetric.COUNT:
-                    matrix[i][j] = len(good)
-                    matrix[j][i] = len(good)
+            list_of_images = store.get_all(images, workers)
+            cache = PairSimilarityCache(matcher)
+            dtype = float32 if len(images) >= SimilarityMatrix.FLOAT32_SIZE else float64
+            if sparse:
+                # The graph is built from blocks of rows, so the dense matrix is never held whole.
+                rows = cache.rows(store.keys(images), list_of_images, MatchingEngine(workers), dtype)
+                matrix = top_k_rows(rows, len(images), neighbors)
             else:
-                if similarity_metric == SimilarityMetric.INVERSE_DISTANCE:
-                    matrix[i][i] = 1
-                elif similarity_metric == SimilarityMetric.COUNT:
-                    matrix[i][i] = nfeatures
-        print('CLUSTER: AffinityPropagation')
-        cluster = AffinityPropagation(
-            damping=damping,
-            max_iter=max_iter,
-            convergence_iter=convergence_iter,
-            affinity=affinity.value,
-            random_state=0,
-        ).fit_predict(matrix).tolist()
+                matrix = cache.matrix(store.keys(images), list_of_images, MatchingEngine(workers), dtype)
+                matrix_store.save(matrix, matcher.key(), images)
+            cache.close()
+        if sparse and not graph_store.exists():
+            if not isinstance(matrix, csr_matrix):
+                matrix = top_k(matrix, neighbors)
+            graph_store.save(matrix, '%s/top %i matched' % (matcher.key(), neighbors), images)
+        cluster = affinity_propagation(matrix, affinity, neighbors, damping, max_iter, convergence_iter, preference)
         return ClusterResults(images, cluster)
 
 
@@ -13,6 +13,10 @@ class Architecture(ABC):
     Factory for keras.models.Model.
     """
 
+    # The input resolution and batch size of new models.
+    RESOLUTION: int = 190
+    BATCH_SIZE: int = 10
+
     @property
     @staticmethod
     @abstractmethod
@@ -155,3 +159,15 @@ class CompiledArchitecture(object):
 
     def summary(self, res: Resolution, classes: Optional[int]) -> None:
         return self._architecture.summary(res, classes)
+
+    def resolution(self) -> Resolution:
+        """
+        Returns the input resolution of new models.
+        """
+        return Resolution(self._architecture.RESOLUTION)
+
+    def batch_size(self) -> int:
+        """
+        Returns the batch size of new models.
+        """
+        return self._architecture.BATCH_SIZE
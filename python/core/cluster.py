@@ -2,11 +2,16 @@ import hashlib
 import json
 import os.path
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Tuple, Union
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import dill
+from numpy import (argsort, asarray, bincount, concatenate, cumsum, diff,
+                   int32, ndarray)
 
-from core.jl import ImageDirectory, hash_images, mkdirname
+from core.fingerprint import fingerprint_images
+from core.jl import ImageDirectory, hash_images
+from core.resultstore import ResultStore
 from core.typing2 import Url
 
 
@@ -31,17 +36,48 @@ class ClusterResult(object):
 
 class ClusterResults(object):
     """
+    The cluster label of each image.
+    Labels are an int32 array.
+    The images of each cluster are grouped once on first use by sorting the labels, like the rows of a CSR matrix.
     """
 
-    def __init__(self, images: List[Url], clusters: List[int]) -> None:
+    def __init__(self, images: List[Url], clusters: Union[List[int], ndarray]) -> None:
         self._images = images
-        self._clusters = clusters
+        self._labels = asarray(clusters, int32).reshape(len(images))
+        self._order: Optional[ndarray] = None
+        self._offsets: Optional[ndarray] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return self.serialize()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        if '_clusters' in state:
+            # Pickled before labels were an array.
+            state = {'images': state['_images'], 'labels': state['_clusters']}
+        self.__init__(state['images'], state['labels'])
+
+    def serialize(self) -> Dict[str, Any]:
+        """
+        Returns the images and the label array without the grouping, which is rebuilt on demand.
+        """
+        return {'images': self._images, 'labels': self._labels}
+
+    @classmethod
+    def deserialize(cls, data: Dict[str, Any]) -> 'ClusterResults':
+        return cls(data['images'], data['labels'])
+
+    def _group(self) -> None:
+        if self._order is None:
+            self._order = argsort(self._labels, kind='stable')
+            self._offsets = concatenate(([0], cumsum(bincount(self._labels, minlength=self.k()))))
 
     def k(self) -> int:
         """
         Returns the number of clusters.
         """
-        return max(self._clusters) + 1
+        if self._offsets is not None:
+            return len(self._offsets) - 1
+        return int(self._labels.max()) + 1 if len(self._labels) > 0 else 0
 
     def get_all_urls(self) -> List[Url]:
         """
@@ -51,17 +87,37 @@ class ClusterResults(object):
     def labels(self) -> List[int]:
         """
         """
-        return self._clusters
+        return self._labels.tolist()
+
+    def label_array(self) -> ndarray:
+        """
+        Returns the labels as a read-only array.
+        """
+        labels = self._labels.view()
+        labels.flags.writeable = False
+        return labels
+
+    def sizes(self) -> ndarray:
+        """
+        Returns the number of images in each cluster.
+        """
+        self._group()
+        return diff(self._offsets)
+
+    def cluster_indices(self, cluster: int) -> ndarray:
+        """
+        Returns the indices of the images in one cluster.
+        """
+        self._group()
+        return self._order[self._offsets[cluster]:self._offsets[cluster + 1]]
 
     def indices(self) -> List[List[int]]:
         """
         Returns a list of clusters.
         Each cluster is a list of indices.
         """
-        l = [list() for _ in range(self.k())]
-        for image, cluster in enumerate(self._clusters):
-            l[cluster].append(image)
-        return l
+        self._group()
+        return [self._order[a:b].tolist() for a, b in zip(self._offsets[:-1], self._offsets[1:])]
 
     def urls(self) -> List[List[Url]]:
         """
@@ -76,6 +132,9 @@ class ClusterStrategy(ABC):
     A clustering algorithm for images.
     """
 
+    # Arguments that change how a strategy runs but not its results.
+    RUNTIME_ARGS: List[str] = ['workers']
+
     @abstractmethod
     def run(self,  images: List[Url], **kwargs) -> ClusterResults:
         """
@@ -83,23 +142,56 @@ class ClusterStrategy(ABC):
         """
         pass
 
+    def _cache_args(self, **kwargs) -> Dict[str, Any]:
+        """
+        Returns the arguments that affect the results in JSON serializable form.
+        """
+        return {k: v.value if isinstance(v, Enum) else v for k, v in kwargs.items() if k not in self.RUNTIME_ARGS}
+
+    def _cache_key(self, images: List[Url], **kwargs) -> str:
+        md5 = hashlib.md5()
+        md5.update(type(self).__name__.encode())
+        md5.update(json.dumps(self._cache_args(**kwargs)).encode())
+        return '%s-%s' % (fingerprint_images(images), md5.hexdigest())
+
     def _cache_path(self, images: List[Url], **kwargs) -> Url:
+        """
+        Returns where results were pickled before the result store.
+        """
         md5 = hashlib.md5()
         md5.update(type(self).__name__.encode())
-        md5.update(json.dumps(kwargs).encode())
+        md5.update(json.dumps(self._cache_args(**kwargs)).encode())
         return "cache/%s/cluster/%s.dill" % (hash_images(images), md5.hexdigest())
 
+    def is_cached(self, images: List[Url], **kwargs) -> bool:
+        """
+        Returns true if run_cached would return saved results instead of running.
+        """
+        return ResultStore().contains(self._cache_key(images, **kwargs)) or os.path.exists(self._cache_path(images, **kwargs))
+
     def run_cached(self, images: List[Url], **kwargs) -> ClusterResults:
+        key = self._cache_key(images, **kwargs)
+        store = ResultStore()
+        entry = store.get(key)
+        if entry is not None:
+            meta, labels = entry
+            # The key covers the contents of the images in order, so the labels belong to the current URLs.
+            return ClusterResults(images, labels)
         filepath = self._cache_path(images, **kwargs)
-        mkdirname(filepath)
         if os.path.exists(filepath):
             print('LOADING: %s' % filepath)
             with open(filepath, 'rb') as f:
-                return dill.load(f)
-        results = self.run(images, **kwargs)
-        print('SAVING: %s' % filepath)
-        with open(filepath, 'wb') as f:
-            dill.dump(results, f)
+                results = dill.load(f)
+            # Pickled results were keyed by the sorted paths, so their order can differ from the images.
+            index = {url: i for i, url in enumerate(results.get_all_urls())}
+            results = ClusterResults(images, results.label_array()[[index[url] for url in images]])
+        else:
+            results = self.run(images, **kwargs)
+        store.put(key, results.label_array(), {
+            'strategy': type(self).__name__,
+            'args': self._cache_args(**kwargs),
+            'images': results.get_all_urls(),
+        })
         return results
 
 
@@ -1,12 +1,18 @@
+import json
+import os
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from os.path import isfile
 from typing import Any, Dict, List, Optional, Tuple
 
 from keras.utils import to_categorical
-from numpy import ndarray
+from numpy import load, ndarray, uint8
+from numpy.lib.format import open_memmap
 from sklearn.model_selection import train_test_split
 
-from core.jl import npexists, npload, npsave
+from core.fingerprint import fingerprint_images
+from core.jl import Resolution, mkdirname, npexists, npload, npsave, resize_img
 from core.modeltype import OutputType
 from core.typing2 import ArrayLike, number
 
@@ -67,6 +73,77 @@ class DataSetXY(object):
         return npexists(self)
 
 
+class DataSetImages(object):
+    """
+    The images of a phase decoded and resized once and saved as a uint8 NumPy file.
+    The file is memory-mapped on load, so batches are sliced from it without decoding any JPEG files.
+    It is made again when the resolution changes or the contents of the images change.
+    """
+
+    def __init__(self, name: str, split: int, phase: Phase, res: Resolution) -> None:
+        self.name: str = name
+        self.split: int = split
+        self.phase: Phase = phase
+        self.res: Resolution = res
+
+    def __str__(self) -> str:
+        return 'cache/images/%s/%d/%s-%dx%dx%d' % ((self.name, self.split, self.phase.value) + self.res.hwc())
+
+    def _meta(self) -> Dict[str, Any]:
+        url = '%s.json' % self
+        if not isfile(url):
+            return dict()
+        try:
+            with open(url) as f:
+                return json.load(f)
+        except ValueError:
+            return dict()
+
+    def is_current(self, images: List[str]) -> bool:
+        """
+        Returns true if the file was made from these images at this resolution.
+        """
+        return isfile('%s.npy' % self) and self._meta().get('fingerprint') == fingerprint_images(images)
+
+    def save(self, images: List[str], workers: int = 1) -> None:
+        """
+        Decodes and resizes the images into the file.
+        The file is written under a temporary name first so readers never see a partial file.
+        """
+        url = '%s.npy' % self
+        mkdirname(url, False)
+        print('SAVING: %s' % url)
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        array = open_memmap(temp, mode='w+', dtype=uint8, shape=self.res.array_hwc(len(images)))
+
+        def work(i: int) -> None:
+            array[i] = resize_img(images[i], self.res)
+
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            for n, _ in enumerate(pool.map(work, range(len(images))), 1):
+                if n % 100 == 0 or n == len(images):
+                    print('IMAGES: %i / %i' % (n, len(images)))
+        array.flush()
+        del array
+        os.replace(temp, url)
+        # The metadata goes last because it marks a complete file.
+        url = '%s.json' % self
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({'fingerprint': fingerprint_images(images), 'shape': self.res.array_hwc(len(images))}, f)
+        os.replace(temp, url)
+
+    def load(self, images: List[str], workers: int = 1) -> ndarray:
+        """
+        Returns the decoded images as a read-only memory-mapped array.
+        Makes the file first if it is missing or out of date.
+        """
+        if not self.is_current(images):
+            self.save(images, workers)
+        print('LOADING: %s.npy' % self)
+        return load('%s.npy' % self, mmap_mode='r')
+
+
 class DataSetPhase(object):
     """
     Represents a training, test, or validation phase for deep learning.
@@ -95,6 +172,12 @@ class DataSetPhase(object):
         """
         return self._get_xy(XY.Y)
 
+    def images(self, res: Resolution, workers: int = 1) -> ndarray:
+        """
+        Gets the images of the input x decoded and resized to a resolution.
+        """
+        return DataSetImages(self.name, self.split, self.phase, res).load(self.x().load(False).tolist(), workers)
+
     def exists(self) -> bool:
         """
         Returns true if all files exist.
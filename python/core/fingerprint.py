@@ -0,0 +1,142 @@
+import hashlib
+import os
+import sqlite3
+from os.path import abspath, dirname
+from threading import Lock
+from typing import List, Optional
+
+from core.typing2 import Url
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def digest_file(url: Url, algorithm: str = 'md5') -> str:
+    """
+    Returns the hexadecimal digest of the contents of a file.
+    The algorithm is md5, blake2b, or xxh3 if the xxhash package is installed.
+    """
+    if algorithm == 'xxh3':
+        if xxhash is None:
+            raise ValueError('xxh3 needs the xxhash package')
+        h = xxhash.xxh3_128()
+    elif algorithm == 'blake2b':
+        h = hashlib.blake2b(digest_size=16)
+    else:
+        h = hashlib.new(algorithm)
+    with open(url, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+ALGORITHMS = ['md5', 'blake2b', 'xxh3']
+
+
+class FingerprintStore(object):
+    """
+    Content fingerprints of files memoized in SQLite.
+    A file whose size, modification time, and inode have not changed is not read again.
+    A renamed or moved file keeps its inode and modification time, so it is found without being read either.
+    The default algorithm is MD5, whose fingerprints are the plain digests, which keeps the content addresses of existing caches valid.
+    Fingerprints from other algorithms are hashed together with the name of the algorithm, so they never address the same cache entries as MD5.
+    They are still 32 hexadecimal digits like MD5, so every store can hold them.
+    """
+
+    URL = 'cache/fingerprints.sqlite'
+    # The algorithm of the shared store, which use_algorithm changes.
+    ALGORITHM = 'md5'
+    _shared: Optional['FingerprintStore'] = None
+
+    def __init__(self, url: Url = URL, algorithm: str = 'md5') -> None:
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown fingerprint algorithm: %s' % algorithm)
+        os.makedirs(dirname(url), exist_ok=True)
+        self._algorithm = algorithm
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(url, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS file (path TEXT, algorithm TEXT, device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, PRIMARY KEY (path, algorithm))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS file_inode ON file (device, inode, size, mtime_ns, algorithm)')
+        self._db.commit()
+
+    @classmethod
+    def shared(cls) -> 'FingerprintStore':
+        """
+        Returns the store used by this process.
+        """
+        if cls._shared is None or cls._shared._pid != os.getpid() or cls._shared._algorithm != cls.ALGORITHM:
+            cls._shared = cls(algorithm=cls.ALGORITHM)
+        return cls._shared
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _fingerprint(self, url: Url) -> str:
+        path = abspath(url)
+        stat = os.stat(path)
+        row = self._db.execute(
+            'SELECT device, inode, size, mtime_ns, digest FROM file WHERE path = ? AND algorithm = ?',
+            (path, self._algorithm),
+        ).fetchone()
+        if row is not None and tuple(row[:4]) == (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return row[4]
+        row = self._db.execute(
+            'SELECT digest FROM file WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND algorithm = ?',
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, self._algorithm),
+        ).fetchone()
+        if row is not None:
+            digest = row[0]
+        elif self._algorithm == 'md5':
+            digest = digest_file(path, self._algorithm)
+        else:
+            digest = hashlib.md5(('%s:%s' % (self._algorithm, digest_file(path, self._algorithm))).encode()).hexdigest()
+        self._db.execute(
+            'INSERT OR REPLACE INTO file (path, algorithm, device, inode, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, self._algorithm, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, digest),
+        )
+        return digest
+
+    def fingerprint(self, url: Url) -> str:
+        """
+        Returns the content fingerprint of a file.
+        """
+        return self.fingerprints([url])[0]
+
+    def fingerprints(self, urls: List[Url]) -> List[str]:
+        """
+        Returns the content fingerprints of many files in one transaction.
+        """
+        with self._lock:
+            digests = [self._fingerprint(url) for url in urls]
+            self._db.commit()
+        return digests
+
+
+def use_algorithm(algorithm: str) -> None:
+    """
+    Chooses the algorithm of the fingerprints that key the caches.
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown fingerprint algorithm: %s' % algorithm)
+    FingerprintStore.ALGORITHM = algorithm
+
+
+def fingerprint(url: Url) -> str:
+    """
+    Returns the content fingerprint of a file.
+    """
+    return FingerprintStore.shared().fingerprint(url)
+
+
+def fingerprint_images(images: List[Url]) -> str:
+    """
+    Returns a hash of the contents of a list of images in order.
+    The same files under other names give the same hash, and an edited file gives a new one.
+    """
+    md5 = hashlib.md5()
+    for digest in FingerprintStore.shared().fingerprints(images):
+        md5.update(digest.encode())
+    return md5.hexdigest()
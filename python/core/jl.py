@@ -43,8 +43,40 @@ def npexists(name: str) -> bool:
     return isfile("out/%s.npy" % name)
 
 
-def read_image(image: Url) -> Image:
-    return cv.imread(image, cv.IMREAD_COLOR)
+class ImageReduction(Enum):
+    """
+    The factor by which JPEG images are scaled down while they are decoded.
+    """
+    FULL = 1
+    HALF = 2
+    QUARTER = 4
+    EIGHTH = 8
+
+
+_IMREAD_FLAGS = {
+    ImageReduction.FULL: cv.IMREAD_COLOR,
+    ImageReduction.HALF: cv.IMREAD_REDUCED_COLOR_2,
+    ImageReduction.QUARTER: cv.IMREAD_REDUCED_COLOR_4,
+    ImageReduction.EIGHTH: cv.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def read_image(image: Url, reduction: ImageReduction = ImageReduction.FULL, max_side: int = 0) -> Image:
+    """
+    Loads a BGR image.
+    A reduction makes the JPEG decoder skip the work for the discarded resolution, which is much cheaper than resizing afterwards.
+    Images with a side longer than max_side are then shrunk to fit, unless max_side is 0.
+    """
+    if not isinstance(reduction, ImageReduction):
+        reduction = ImageReduction(reduction)
+    img = cv.imread(image, _IMREAD_FLAGS[reduction])
+    if img is not None and max_side > 0:
+        height, width = img.shape[:2]
+        if max(height, width) > max_side:
+            scale = max_side / max(height, width)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            img = cv.resize(img, size, interpolation=cv.INTER_AREA)
+    return img
 
 
 def readimg2(images: List[Url]) -> List[Image]:
@@ -436,6 +468,10 @@ def copy_file(file_: Url, directory: Url, ancestors: int = 0) -> None:
 
 
 def hash_images(images: List[Url]) -> str:
+    """
+    Returns a hash of the sorted paths of images.
+    Only identifies caches written before they were keyed by content.
+    """
     md5 = hashlib.md5()
     for image in sorted(images):
         md5.update(image.encode())
@@ -4,16 +4,18 @@ import enum
 import os
 import sys
 import warnings
+from time import perf_counter
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import dill
 import keras
 import numpy as np
 from keras.callbacks import Callback
 from keras.utils import Sequence
-from numpy import asarray, ceil, ndarray
+from numpy import asarray, ceil, ndarray, uint8, zeros
 
+from core.dataset import DataSetPhase
 from core.jl import Resolution, resize_img
 from core.typing2 import Url
 
@@ -21,13 +23,19 @@ from core.typing2 import Url
 class Sequence1(Sequence):
     """
     Generate batches of data.
+    The x set is either image URLs, which are decoded and resized for every batch, or images already decoded at the resolution, which are sliced without copying.
+    With buffers, URLs are decoded into a ring of preallocated batches instead of a new array per batch.
+    The ring must be longer than the number of batches that are queued or being made at once.
     """
 
-    def __init__(self, x_set: ndarray, y_set: ndarray, res: Resolution, batch_size: int):
+    def __init__(self, x_set: ndarray, y_set: ndarray, res: Resolution, batch_size: int, buffers: int = 0):
         self.x = x_set
         self.y = y_set
         self.batch_size = batch_size
         self._res = res
+        self._buffers = None
+        if buffers > 0 and self.x.ndim != 4:
+            self._buffers = zeros((buffers,) + res.array_hwc(batch_size), uint8)
 
     def __len__(self):
         a = float(len(self.x)) / float(self.batch_size)
@@ -39,11 +47,86 @@ class Sequence1(Sequence):
         b = (idx + 1) * self.batch_size
         batch_x = self.x[a:b]
         batch_y = self.y[a:b]
-        xx = asarray([resize_img(filename, self._res) for filename in batch_x])
+        if self.x.ndim == 4:
+            xx = batch_x
+        elif self._buffers is not None:
+            xx = self._buffers[idx % len(self._buffers), :len(batch_x)]
+            for i, filename in enumerate(batch_x):
+                xx[i] = resize_img(filename, self._res)
+        else:
+            xx = asarray([resize_img(filename, self._res) for filename in batch_x])
         yy = asarray(batch_y)
         return xx, yy
 
 
+class DataLoader(object):
+    """
+    Settings for how Keras makes batches ahead of the model.
+    Workers are threads, or processes with multiprocessing, that each make one batch at a time.
+    At most max_queue_size finished batches wait for the model.
+    """
+
+    def __init__(self, workers: int = 1, use_multiprocessing: bool = False, max_queue_size: int = 10) -> None:
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+        self.max_queue_size = max_queue_size
+
+    def inputs(self, phase: DataSetPhase, res: Resolution) -> ndarray:
+        """
+        Returns the x set of a phase in the form that the sequences take, which is the decoded images.
+        """
+        return phase.images(res, self.workers)
+
+    def sequence(
+        self,
+        x_set: ndarray,
+        y_set: ndarray,
+        res: Resolution,
+        batch_size: int,
+        training: bool = False,
+        phase: Optional[DataSetPhase] = None,
+    ) -> Sequence:
+        """
+        Returns a sequence with enough batch buffers for every batch that can be queued or in progress.
+        Batches keep the order of the x set, for training too.
+        The phase is given when the x set is the whole x of a phase.
+        """
+        return Sequence1(x_set, y_set, res, batch_size, self.max_queue_size + self.workers + 2)
+
+    def kwargs(self) -> Dict[str, Any]:
+        """
+        Returns the keyword arguments for fit_generator, evaluate_generator, and predict_generator.
+        """
+        return {
+            'workers': self.workers,
+            'use_multiprocessing': self.use_multiprocessing,
+            'max_queue_size': self.max_queue_size,
+        }
+
+
+class LoaderStallCallback(Callback):
+    """
+    Callback that reports how long training waited for batches in each epoch.
+    The wait is the time between the end of one batch and the start of the next, which is when Keras takes a batch from the loader.
+    It goes last in the list of callbacks so the other callbacks are not counted.
+    """
+
+    def on_epoch_begin(self, epoch: int, logs: Dict = None) -> None:
+        self._start = perf_counter()
+        self._last = self._start
+        self._stall = 0.0
+
+    def on_batch_begin(self, batch: int, logs: Dict = None) -> None:
+        self._stall += perf_counter() - self._last
+
+    def on_batch_end(self, batch: int, logs: Dict = None) -> None:
+        self._last = perf_counter()
+
+    def on_epoch_end(self, epoch: int, logs: Dict = None) -> None:
+        elapsed = max(self._last - self._start, 1e-9)
+        print('LOADER: epoch %05d waited %.1f s for batches, %.0f%% of %.1f s' % (epoch + 1, self._stall, 100 * self._stall / elapsed, elapsed))
+
+
 class TrainingStatus(enum.Enum):
     PENDING = 'pending'
     TRAINING = 'training'
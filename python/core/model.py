@@ -3,29 +3,32 @@ import json
 import os
 from enum import Enum, auto
 from os.path import isfile
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import dill
 import keras.models
 import tensorflow as tf
 from keras.backend import clear_session
 from keras.callbacks import CSVLogger, ReduceLROnPlateau
-from numpy import argmax, asarray, ndarray
+from numpy import argmax, asarray, ndarray, zeros
 from sklearn.metrics import (accuracy_score, f1_score, precision_score,
                              recall_score)
 
 from core.architecture import (Architecture, CompiledArchitecture,
                                CompiledArchitectureName, CompileOption)
-from core.dataset import DataSet, DataSetSplit, DataSetSplitName
+from core.dataset import DataSet, DataSetPhase, DataSetSplit, DataSetSplitName
 from core.epoch import EpochObserver, EpochPickle
-from core.jl import ListFile, Resolution, hash_images, mkdirname, mkdirs
-from core.kerashelper import (CompletionStatusObserver, ModelCheckpoint2,
+from core.fingerprint import fingerprint_images
+from core.jl import ListFile, Resolution, mkdirname, mkdirs
+from core.kerashelper import (CompletionStatusObserver, DataLoader,
+                              LoaderStallCallback, ModelCheckpoint2,
                               ModelCheckpoint2Observer, ModelCheckpoint2Pickle,
                               NanInfStatusObserver, SaveKmodelObserver,
-                              Sequence1, TerminateOnDemand,
+                              TerminateOnDemand,
                               TerminateOnNanInfObserver, TrainingStatus,
                               TrainingStatusData)
 from core.reducelr import ReduceLROnPlateauObserver, ReduceLROnPlateauPickle
+from core.tuning import BatchTuner, ModelSettings
 from core.typing2 import Image, Url
 
 
@@ -102,14 +105,21 @@ class ModelSplitName(object):
     def status(self) -> Url:
         return '%s/status.txt' % self.dirname()
 
+    def settings(self) -> Url:
+        """
+        Returns the URL of the resolution and batch size.
+        """
+        return '%s/settings.json' % self.dirname()
+
     def list_all(self) -> List[Url]:
         return [
             self.status(),
             self.log(),
+            self.settings(),
         ] + self.best.list_all() + self.latest.list_all()
 
     def prediction_cache(self, images: List[Url]) -> Url:
-        return "cache/%s/%s/prediction.dill" % (hash_images(images), self.model_id())
+        return "cache/%s/%s/prediction.dill" % (fingerprint_images(images), self.model_id())
 
     def evaluation_cache(self) -> Url:
         return "cache/%s" % self.model_id()
@@ -248,12 +258,14 @@ class KerasAdapter(object):
         data: DataSetSplit,
         epochs: int,
         patience: int,
+        loader: DataLoader = None,
     ) -> None:
         """
         # Arguments
         epochs:
         - 0 for automatically stopping when training yields no improvements for a specified number of epochs
         - any positive integer for a set number of epochs
+        loader: how batches are made ahead of the model
         """
         self._architecture: CompiledArchitecture = architecture
         self._data: DataSetSplit = data
@@ -268,8 +280,15 @@ class KerasAdapter(object):
         self._patience: int = patience
         self._is_best: bool = False
         self._status: TrainingStatusData = None
-        self._res = Resolution(190)
-        self._batch = 10
+        self._settings: ModelSettings = ModelSettings.load(self._names.settings())
+        if self._settings is None:
+            if isfile(self._names.latest.weights()):
+                self._settings = ModelSettings.legacy()
+            else:
+                self._settings = ModelSettings(architecture.resolution(), architecture.batch_size())
+        self._res: Resolution = self._settings.res
+        self._batch: int = self._settings.batch_size
+        self._loader: DataLoader = loader or DataLoader()
 
     def __enter__(self):
         return self
@@ -334,20 +353,21 @@ class KerasAdapter(object):
         callbacks.append(log)
         callbacks.append(mcp)
         callbacks.append(term)
+        callbacks.append(LoaderStallCallback())
 
         total_epochs = self._total_epochs
         if self._total_epochs == 0:
             total_epochs = 2**64
 
         # Training set
-        x1 = self._data.train().x().load()
+        x1 = self._loader.inputs(self._data.train(), self._res)
         y1 = self._data.train().y().load()
-        x2 = self._data.validation().x().load()
+        x2 = self._loader.inputs(self._data.validation(), self._res)
         y2 = self._data.validation().y().load()
         # print('Training sequence')
-        seq1 = Sequence1(x1, y1, self._res, self._batch)
+        seq1 = self._loader.sequence(x1, y1, self._res, self._batch, training=True, phase=self._data.train())
         # print('Validation sequence')
-        seq2 = Sequence1(x2, y2, self._res, self._batch)
+        seq2 = self._loader.sequence(x2, y2, self._res, self._batch, phase=self._data.validation())
 
         # Training
         print('TRAINING: %s\n' % self._names.dirname())
@@ -360,6 +380,7 @@ class KerasAdapter(object):
                 shuffle=False,
                 initial_epoch=current_epoch,
                 callbacks=callbacks,
+                **self._loader.kwargs()
             )
         except tf.errors.ResourceExhaustedError:
             print('\nTraining resource exhaustion: %s' % self._names.dirname())
@@ -376,15 +397,17 @@ class KerasAdapter(object):
             print('Training completed: %s' % self._names.dirname())
         return self._status.status
 
-    def evaluate(self, x: ndarray, y: ndarray) -> Dict[str, float]:
+    def evaluate(self, x: ndarray, y: ndarray, phase: Optional[DataSetPhase] = None) -> Dict[str, float]:
         """
         Evaluates the model using the given x and y.
+        The phase is given when they are the whole x and y of a phase.
         Returns a list of metrics.
         """
-        seq = Sequence1(x, y, self._res, self._batch)
+        seq = self._loader.sequence(x, y, self._res, self._batch, phase=phase)
         results: List[float] = self._kmodel.evaluate_generator(
             generator=seq,
             verbose=1,
+            **self._loader.kwargs()
         )
         return {metric: scalar for metric, scalar in zip(self._kmodel.metrics_names, results)}
 
@@ -406,9 +429,9 @@ class KerasAdapter(object):
             print("LOADING: %s" % filepath)
             with open(filepath, 'rb') as f:
                 return dill.load(f)
-        x = self._data.train().x().load()
+        x = self._loader.inputs(self._data.train(), self._res)
         y = self._data.train().y().load()
-        results = self.evaluate(x, y)
+        results = self.evaluate(x, y, self._data.train())
         mkdirname(filepath)
         print("SAVING: %s" % filepath)
         with open(filepath, 'wb') as f:
@@ -424,9 +447,9 @@ class KerasAdapter(object):
             print("LOADING: %s" % filepath)
             with open(filepath, 'rb') as f:
                 return dill.load(f)
-        x = self._data.validation().x().load()
+        x = self._loader.inputs(self._data.validation(), self._res)
         y = self._data.validation().y().load()
-        results = self.evaluate(x, y)
+        results = self.evaluate(x, y, self._data.validation())
         mkdirname(filepath)
         print("SAVING: %s" % filepath)
         with open(filepath, 'wb') as f:
@@ -442,9 +465,9 @@ class KerasAdapter(object):
             print("LOADING: %s" % filepath)
             with open(filepath, 'rb') as f:
                 return dill.load(f)
-        x = self._data.test().x().load()
+        x = self._loader.inputs(self._data.test(), self._res)
         y = self._data.test().y().load()
-        results = self.evaluate(x, y)
+        results = self.evaluate(x, y, self._data.test())
         mkdirname(filepath)
         print("SAVING: %s" % filepath)
         with open(filepath, 'wb') as f:
@@ -460,10 +483,13 @@ class KerasAdapter(object):
         if os.path.exists(filepath):
             print("LOADING: %s" % filepath)
             with open(filepath, 'rb') as f:
-                return dill.load(f)
+                results = dill.load(f)
+            # The cache is keyed by the contents of the images, which may have moved since.
+            results.x = images
+            return results
         x = asarray(images)
-        seq = Sequence1(x, x, self._res, self._batch)
-        predictions: ndarray = self._kmodel.predict_generator(generator=seq, verbose=1)
+        seq = self._loader.sequence(x, x, self._res, self._batch)
+        predictions: ndarray = self._kmodel.predict_generator(generator=seq, verbose=1, **self._loader.kwargs())
         if simple:
             if predictions.ndim == 2 and predictions.shape[1] == 1:
                 predictions = predictions.flatten()
@@ -509,6 +535,7 @@ class KerasAdapter(object):
                 self._status = TrainingStatusData.load(self._names.status())
             self._status.status = TrainingStatus.TRAINING
             self._status.save()
+            self._settings.save(self._names.settings())
 
             # Blank model and training state
             self._kmodel = self._architecture.compile(self._res, self._data.classes)
@@ -585,6 +612,18 @@ class KerasAdapter(object):
             self._status.status = TrainingStatus.RESOURCE2
             self._status.save()
 
+    def tune(self, budget: int) -> ModelSettings:
+        """
+        Chooses the batch size that trains fastest within a memory budget in bytes and saves it next to the model.
+        The resolution of a saved model is kept, since its weights only fit that resolution.
+        """
+        mkdirs(self._names.dirname())
+        self._kmodel = None
+        self._settings = BatchTuner(self._architecture, self._data.classes, self._res, budget).run()
+        self._settings.save(self._names.settings())
+        self._batch = self._settings.batch_size
+        return self._settings
+
     def is_loaded(self) -> bool:
         """
         Returns true if the weights are loaded.
@@ -631,6 +670,24 @@ class KerasAdapter(object):
         clear_session()
         gc.collect()
 
+    def release(self) -> None:
+        """
+        Drops the Keras model without clearing the session, which may hold other models.
+        """
+        self._kmodel = None
+
+    def warm_up(self) -> None:
+        """
+        Runs the loaded model once so later predictions do not pay for building the prediction function.
+        """
+        self._kmodel.predict_on_batch(zeros(self._res.array_hwc(1), 'float32'))
+
+    def nbytes(self) -> int:
+        """
+        Returns the memory that the weights of the loaded model take.
+        """
+        return 4 * self._kmodel.count_params()
+
     def summary(self) -> None:
         return self._architecture.summary(self._res, self._data.classes)
 
@@ -645,11 +702,13 @@ class ModelSplit(object):
         data: DataSetSplit,
         epochs: int,
         patience: int,
+        loader: DataLoader = None,
     ) -> None:
         self._architecture = architecture
         self._data = data
         self._epochs = epochs
         self._patience = patience
+        self._loader = loader
 
     def status(self) -> TrainingStatus:
         with KerasAdapter(
@@ -657,6 +716,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             return kadapter.status()
 
@@ -666,6 +726,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             return kadapter.is_complete()
 
@@ -675,6 +736,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             return kadapter.has_error()
 
@@ -687,6 +749,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if self.is_complete():
                 return TrainingStatus.COMPLETE
@@ -707,6 +770,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -725,6 +789,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -743,6 +808,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -750,6 +816,26 @@ class ModelSplit(object):
                 kadapter.load()
             return kadapter.evaluate_test_set()
 
+    def adapter(self) -> KerasAdapter:
+        """
+        Returns a KerasAdapter with the trained model loaded.
+        The caller closes or releases it.
+        The session is not cleared, so the model can be loaded into a graph of its own.
+        """
+        kadapter = KerasAdapter(
+            self._architecture,
+            self._data,
+            self._epochs,
+            self._patience,
+            self._loader,
+        )
+        if not kadapter.is_complete():
+            raise TrainingIncompleteException()
+        if not kadapter.is_saved():
+            raise ModelStateMissingError()
+        kadapter.load()
+        return kadapter
+
     def predict(self, images: List[Url], simple: bool) -> Prediction:
         """
         Takes the input and returns an output
@@ -761,6 +847,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -778,6 +865,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -795,6 +883,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -812,6 +901,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.is_saved():
                 raise ModelStateMissingError()
@@ -824,6 +914,7 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             kadapter.delete(keep_history)
 
@@ -833,15 +924,27 @@ class ModelSplit(object):
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             return kadapter.summary()
 
+    def tune(self, budget: int) -> ModelSettings:
+        with KerasAdapter(
+            self._architecture,
+            self._data,
+            self._epochs,
+            self._patience,
+            self._loader,
+        ) as kadapter:
+            return kadapter.tune(budget)
+
     def auto_train(self) -> None:
         with KerasAdapter(
             self._architecture,
             self._data,
             self._epochs,
             self._patience,
+            self._loader,
         ) as kadapter:
             if not kadapter.has_error() and not kadapter.is_complete():
                 if not kadapter.is_saved():
@@ -886,6 +989,7 @@ class Model(object):
         metrics: CompileOption,
         epochs: int,
         patience: int,
+        loader: DataLoader = None,
     ) -> None:
         self._architecture: CompiledArchitecture = CompiledArchitecture(
             architecture,
@@ -898,6 +1002,7 @@ class Model(object):
             raise BadModelSettings('Architecture and data set are not compatible')
         self._epochs: int = epochs
         self._patience: int = patience
+        self._loader: DataLoader = loader
 
     def status(self) -> TrainingStatus:
         for i in range(self._dataset.splits()):
@@ -923,6 +1028,7 @@ class Model(object):
             self._dataset.get_split(num),
             self._epochs,
             self._patience,
+            self._loader,
         )
 
     def train(self) -> TrainingStatus:
@@ -970,3 +1076,10 @@ class Model(object):
         """
         """
         return self.split(0).summary()
+
+    def tune(self, budget: int) -> None:
+        """
+        Chooses the batch size of each split within a memory budget in bytes.
+        """
+        for i in range(self._dataset.splits()):
+            self.split(i).tune(budget)
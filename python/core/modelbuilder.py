@@ -2,6 +2,7 @@ from typing import Dict, Tuple
 
 from core.architecture import Architecture, CompileOption
 from core.dataset import DataSet
+from core.kerashelper import DataLoader
 from core.model import Model
 
 
@@ -31,6 +32,7 @@ class ModelBuilder(object):
         metrics: str,
         epochs: int,
         patience: int,
+        loader: DataLoader = None,
     ) -> Model:
         """
         Builds a deep learning model from a pool of datasets, architectures, and options.
@@ -43,6 +45,7 @@ class ModelBuilder(object):
             cls.METRICS[metrics],
             epochs,
             patience,
+            loader,
         )
 
     @classmethod
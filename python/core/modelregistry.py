@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from typing import Hashable, Iterator, List
+
+import tensorflow as tf
+
+from core.model import KerasAdapter, ModelSplit, Prediction
+from core.typing2 import Url
+
+
+class ResidentModel(object):
+    """
+    A loaded and warmed up model that stays in memory between requests.
+    Each model has its own TensorFlow graph and session, so it can be freed without clearing the others.
+    Each model has its own lock, so different models predict at the same time and one model predicts one request at a time.
+    """
+
+    def __init__(self, split: ModelSplit) -> None:
+        self._lock = Lock()
+        self._graph = tf.Graph()
+        self._session = tf.compat.v1.Session(graph=self._graph)
+        # Requests using the model, which is only closed when there are none.
+        self.users: int = 0
+        self.evicted: bool = False
+        try:
+            with self._scope():
+                self._adapter: KerasAdapter = split.adapter()
+                if not self._adapter.is_loaded():
+                    raise MemoryError('Model could not be loaded')
+                self._adapter.warm_up()
+        except BaseException:
+            self._session.close()
+            raise
+        self.nbytes: int = self._adapter.nbytes()
+
+    @contextmanager
+    def _scope(self):
+        """
+        Makes Keras use the graph and session of this model in the current thread.
+        Keras takes the default session of the thread before its global session, so the global session is left alone and threads do not overwrite each other's.
+        """
+        with self._graph.as_default(), self._session.as_default():
+            yield
+
+    def predict(self, images: List[Url], simple: bool) -> Prediction:
+        """
+        Takes the input and returns an output
+        """
+        with self._lock, self._scope():
+            return self._adapter.predict(images, simple)
+
+    def close(self) -> None:
+        """
+        Frees the model by closing its session.
+        """
+        with self._lock:
+            self._adapter.release()
+            self._session.close()
+
+
+class ModelRegistry(object):
+    """
+    Keeps recently used models loaded so repeated requests skip building the architecture and loading weights.
+    When the weights of the resident models are larger than the limit, the least recently used are freed.
+    The model in use is always kept even if it alone is over the limit.
+    A model that is evicted while requests use it is closed when the last of them is done.
+    """
+
+    MAX_BYTES = 2 * 2 ** 30
+
+    def __init__(self, max_bytes: int = MAX_BYTES) -> None:
+        self._max_bytes = max_bytes
+        self._models: 'OrderedDict[Hashable, ResidentModel]' = OrderedDict()
+        self._lock = Lock()
+
+    @contextmanager
+    def use(self, key: Hashable, split: ModelSplit) -> Iterator[ResidentModel]:
+        """
+        Yields the resident model under a key, loading it from a split if it is not loaded yet.
+        The key names everything that identifies the saved model, such as the architecture, data set, compile options, epochs, patience, and split.
+        The model is not closed until the block exits.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                print('RESIDENT MODEL: %s' % (key,))
+                model = self._models[key]
+            else:
+                print('LOADING MODEL: %s' % (key,))
+                model = ResidentModel(split)
+                self._models[key] = model
+            model.users += 1
+            self._evict()
+        try:
+            yield model
+        finally:
+            with self._lock:
+                model.users -= 1
+                if model.evicted and model.users == 0:
+                    model.close()
+
+    def _release(self, model: ResidentModel) -> None:
+        """
+        Closes a model that left the registry now, or after the requests that use it are done.
+        """
+        model.evicted = True
+        if model.users == 0:
+            model.close()
+
+    def _evict(self) -> None:
+        """
+        Frees the least recently used models until the rest fit in the limit.
+        """
+        total = sum(m.nbytes for m in self._models.values())
+        while total > self._max_bytes and len(self._models) > 1:
+            key, model = self._models.popitem(last=False)
+            print('EVICTING MODEL: %s' % (key,))
+            total -= model.nbytes
+            self._release(model)
+
+    def clear(self) -> None:
+        """
+        Frees every resident model.
+        """
+        with self._lock:
+            while len(self._models) > 0:
+                self._release(self._models.popitem()[1])
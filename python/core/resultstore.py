@@ -0,0 +1,128 @@
+import json
+import os
+from os.path import getsize, isdir, isfile, join
+from time import time
+from typing import Any, Dict, Optional, Tuple
+
+from numpy import load, ndarray, save
+
+from core.jl import mkdirs
+from core.typing2 import Url
+
+
+class ResultStore(object):
+    """
+    Clustering results saved as a JSON file of metadata and a NumPy file of labels.
+    The metadata holds the images, the strategy and its arguments.
+    Files are written under temporary names and renamed, so a crash never leaves a partial entry.
+    An index keeps the size and last access time of every entry.
+    When the entries are larger than the limit, the least recently used are deleted.
+    """
+
+    # Incremented when the format of an entry changes, which makes older entries misses.
+    SCHEMA = 1
+    DIRECTORY = 'cache/results'
+    MAX_BYTES = 256 * 2 ** 20
+
+    def __init__(self, directory: Url = DIRECTORY, max_bytes: int = MAX_BYTES) -> None:
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    def _url(self, key: str, extension: str) -> Url:
+        return join(self._directory, '%s.%s' % (key, extension))
+
+    @staticmethod
+    def _replace(url: Url, write) -> None:
+        """
+        Writes a file under a temporary name and then renames it.
+        """
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        with open(temp, 'wb') as f:
+            write(f)
+        os.replace(temp, url)
+
+    def _index(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the size and last access time of each entry.
+        The index is rebuilt from the directory if it is missing or unreadable.
+        """
+        url = join(self._directory, 'index.json')
+        if isfile(url):
+            try:
+                with open(url) as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+        index = dict()
+        if isdir(self._directory):
+            for name in os.listdir(self._directory):
+                key, extension = os.path.splitext(name)
+                if extension == '.json' and key != 'index' and isfile(self._url(key, 'npy')):
+                    index[key] = {'size': self._size(key), 'atime': os.path.getmtime(self._url(key, 'json'))}
+        return index
+
+    def _save_index(self, index: Dict[str, Dict[str, float]]) -> None:
+        self._replace(join(self._directory, 'index.json'), lambda f: f.write(json.dumps(index).encode()))
+
+    def _size(self, key: str) -> int:
+        return sum(getsize(self._url(key, e)) for e in ('json', 'npy') if isfile(self._url(key, e)))
+
+    def _delete(self, key: str) -> None:
+        # The metadata goes first so the entry stops being valid before its labels disappear.
+        for extension in ('json', 'npy'):
+            if isfile(self._url(key, extension)):
+                os.remove(self._url(key, extension))
+
+    def _evict(self, index: Dict[str, Dict[str, float]]) -> None:
+        """
+        Deletes the least recently used entries until the entries fit in the limit.
+        """
+        total = sum(e['size'] for e in index.values())
+        for key in sorted(index, key=lambda k: index[k]['atime']):
+            if total <= self._max_bytes:
+                break
+            print('EVICTING: %s' % self._url(key, 'json'))
+            total -= index[key]['size']
+            self._delete(key)
+            del index[key]
+
+    def contains(self, key: str) -> bool:
+        """
+        Returns true if labels are saved under a key, without loading them or marking them as used.
+        """
+        return isfile(self._url(key, 'json')) and isfile(self._url(key, 'npy'))
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], ndarray]]:
+        """
+        Returns the metadata and labels saved under a key.
+        Returns none if there are none or they were saved in another schema.
+        """
+        url = self._url(key, 'json')
+        if not isfile(url) or not isfile(self._url(key, 'npy')):
+            return None
+        with open(url) as f:
+            meta = json.load(f)
+        if meta.get('schema') != self.SCHEMA:
+            self._delete(key)
+            return None
+        print('LOADING: %s' % url)
+        labels = load(self._url(key, 'npy'))
+        index = self._index()
+        index[key] = {'size': self._size(key), 'atime': time()}
+        self._save_index(index)
+        return meta, labels
+
+    def put(self, key: str, labels: ndarray, meta: Dict[str, Any]) -> None:
+        """
+        Saves labels under a key with metadata that describes how they were made.
+        """
+        mkdirs(self._directory, False)
+        meta = dict(meta, schema=self.SCHEMA)
+        print('SAVING: %s' % self._url(key, 'json'))
+        # The labels go first because the metadata marks a complete entry.
+        self._replace(self._url(key, 'npy'), lambda f: save(f, labels))
+        self._replace(self._url(key, 'json'), lambda f: f.write(json.dumps(meta).encode()))
+        index = self._index()
+        index[key] = {'size': self._size(key), 'atime': time()}
+        self._evict(index)
+        self._save_index(index)
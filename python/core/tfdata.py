@@ -0,0 +1,126 @@
+import os
+from os.path import isfile
+from typing import Any, Dict, List, Optional
+
+import tensorflow as tf
+from keras.backend import get_session
+from keras.utils import Sequence
+from numpy import ndarray
+
+from core.dataset import DataSetPhase, Phase
+from core.fingerprint import fingerprint_images
+from core.jl import Resolution, mkdirs
+from core.kerashelper import DataLoader
+from core.typing2 import Url
+
+
+class TfDataSequence(Sequence):
+    """
+    Batches taken from a tf.data pipeline.
+    The batches come from one iterator in order, so Keras has to ask for them in order from one thread, which it does without workers.
+    The pipeline repeats, and each epoch takes exactly one pass of batches from it.
+    """
+
+    def __init__(self, dataset: tf.data.Dataset, batches: int) -> None:
+        self._batches = batches
+        self._next = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+
+    def __len__(self) -> int:
+        return self._batches
+
+    def __getitem__(self, idx: int) -> Any:
+        return get_session().run(self._next)
+
+
+class TfDataLoader(DataLoader):
+    """
+    Makes batches with tf.data so TensorFlow decodes and resizes JPEG files on its own threads, outside the GIL, while the model runs.
+    Images are decoded to BGR like OpenCV, but TensorFlow's bicubic resize differs slightly from OpenCV's.
+    Decoded images of the training and validation phases can be cached to files under the directory of their phase.
+    A phase keeps one cache, which is keyed by the resolution and the contents of its images, and older ones are deleted.
+    Images for predictions and test evaluations are decoded every time, since they are read once.
+    TensorFlow locks a cache while writing it, and a process killed during the first epoch leaves the lock behind.
+    Locks of unfinished caches are deleted before the cache is used, which assumes one process trains a split at a time.
+    Training batches are shuffled the same way on every run with the same seed.
+    """
+
+    DIRECTORY = 'cache/tfdata'
+
+    def __init__(self, parallel_calls: int = 0, cache: bool = True, shuffle_buffer: int = 1000, seed: int = 0, prefetch: int = 0) -> None:
+        """
+        # Arguments
+        parallel_calls: images decoded at once, or 0 to let TensorFlow choose
+        prefetch: batches made ahead of the model, or 0 to let TensorFlow choose
+        """
+        super().__init__(workers=0)
+        self.parallel_calls = parallel_calls
+        self.cache = cache
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.prefetch = prefetch
+
+    def inputs(self, phase: DataSetPhase, res: Resolution) -> ndarray:
+        """
+        Returns the image URLs of a phase, since tf.data decodes them itself.
+        """
+        return phase.x().load()
+
+    def _cache(self, phase: DataSetPhase, urls: List[str], res: Resolution) -> Url:
+        """
+        Returns the file prefix of the cache of a phase after deleting stale files of that phase.
+        """
+        directory = '%s/%s/%d' % (self.DIRECTORY, phase.name, phase.split)
+        mkdirs(directory, False)
+        name = '%s-%dx%dx%d-%s' % ((phase.phase.value,) + res.hwc() + (fingerprint_images(urls),))
+        prefix = '%s/%s' % (directory, name)
+        complete = isfile('%s.index' % prefix)
+        for f in os.listdir(directory):
+            stale = f.startswith('%s-' % phase.phase.value) and not f.startswith(name)
+            lock = f.startswith(name) and f.endswith('.lockfile') and not complete
+            if stale or lock:
+                print('DELETING: %s/%s' % (directory, f))
+                os.remove('%s/%s' % (directory, f))
+        return prefix
+
+    @staticmethod
+    def _decode(url: tf.Tensor, res: Resolution) -> tf.Tensor:
+        image = tf.image.decode_jpeg(tf.io.read_file(url), channels=3, dct_method='INTEGER_ACCURATE')
+        image = tf.compat.v1.image.resize_images(image, res.hw(), method=tf.image.ResizeMethod.BICUBIC)
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+        # OpenCV decodes to BGR, which is what the models were trained on.
+        return tf.reverse(image, axis=[-1])
+
+    def sequence(
+        self,
+        x_set: ndarray,
+        y_set: ndarray,
+        res: Resolution,
+        batch_size: int,
+        training: bool = False,
+        phase: Optional[DataSetPhase] = None,
+    ) -> TfDataSequence:
+        """
+        Returns a sequence of batches from a tf.data pipeline.
+        Only training batches are shuffled.
+        """
+        autotune = tf.data.experimental.AUTOTUNE
+        urls = x_set.astype(str)
+        with get_session().graph.as_default():
+            dataset = tf.data.Dataset.from_tensor_slices((urls, y_set))
+            dataset = dataset.map(
+                lambda x, y: (self._decode(x, res), y),
+                num_parallel_calls=self.parallel_calls or autotune,
+            )
+            if self.cache and phase is not None and phase.phase in (Phase.TRAIN, Phase.VALIDATION):
+                dataset = dataset.cache(self._cache(phase, urls.tolist(), res))
+            if training:
+                dataset = dataset.shuffle(self.shuffle_buffer, seed=self.seed, reshuffle_each_iteration=True)
+            dataset = dataset.batch(batch_size).repeat().prefetch(self.prefetch or autotune)
+            batches = (len(urls) + batch_size - 1) // batch_size
+            return TfDataSequence(dataset, batches)
+
+    def kwargs(self) -> Dict[str, Any]:
+        """
+        Returns keyword arguments that make Keras take batches in order on its own thread.
+        """
+        return {'workers': 0}
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import json
+import os
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+import keras.models
+import tensorflow as tf
+from keras.backend import clear_session
+from numpy import prod, zeros
+
+from core.architecture import CompiledArchitecture
+from core.jl import Resolution
+from core.typing2 import Url
+
+
+class ModelSettings(object):
+    """
+    The input resolution and batch size that a model is trained and run with.
+    They are saved next to the weights, since weights only fit the resolution they were trained at.
+    """
+
+    # Models trained before the settings were saved used these.
+    LEGACY_RESOLUTION = 190
+    LEGACY_BATCH_SIZE = 10
+
+    def __init__(self, res: Resolution, batch_size: int, probes: List[Dict[str, float]] = None) -> None:
+        self.res: Resolution = res
+        self.batch_size: int = batch_size
+        self.probes: List[Dict[str, float]] = probes or list()
+
+    @classmethod
+    def legacy(cls) -> ModelSettings:
+        return cls(Resolution(cls.LEGACY_RESOLUTION), cls.LEGACY_BATCH_SIZE)
+
+    def save(self, url: Url) -> None:
+        """
+        Saves the settings under a temporary name and renames them, so a crash never leaves a partial file.
+        """
+        print('SAVING: %s' % url)
+        temp = '%s.%d.tmp' % (url, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({
+                'resolution': list(self.res.hwc()),
+                'batch_size': self.batch_size,
+                'probes': self.probes,
+            }, f, indent=2)
+        os.replace(temp, url)
+
+    @classmethod
+    def load(cls, url: Url) -> Optional[ModelSettings]:
+        """
+        Returns the saved settings or none if there are none.
+        Unreadable settings count as none, so they are tuned again.
+        """
+        try:
+            with open(url) as f:
+                settings: Dict[str, Any] = json.load(f)
+            h, w, c = settings['resolution']
+            batch_size = settings['batch_size']
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            print('UNREADABLE: %s' % url)
+            return None
+        print('LOADING: %s' % url)
+        return cls(Resolution(h, w, c), batch_size, settings.get('probes'))
+
+
+def estimate_bytes(kmodel: keras.models.Model, batch_size: int) -> int:
+    """
+    Returns a rough estimate of the memory needed to train a model on a batch.
+    Weights are counted four times for the gradients and the optimizer state.
+    Layer outputs are counted twice for the backward pass.
+    """
+    activations = 0
+    for layer in kmodel.layers:
+        shapes = layer.output_shape if type(layer.output_shape) == list else [layer.output_shape]
+        for shape in shapes:
+            activations += int(prod([i for i in shape[1:] if i is not None]))
+    return 4 * (4 * kmodel.count_params() + 2 * activations * batch_size)
+
+
+class BatchTuner(object):
+    """
+    Finds the batch size that trains a model fastest within a memory budget.
+    Batch sizes are doubled until the estimated memory exceeds the budget or TensorFlow runs out of memory.
+    Each batch size is timed for training and for inference on blank images.
+    """
+
+    def __init__(
+        self,
+        architecture: CompiledArchitecture,
+        classes: Optional[int],
+        res: Resolution,
+        budget: int,
+        max_batch: int = 256,
+        steps: int = 3,
+    ) -> None:
+        self._architecture = architecture
+        self._classes = classes
+        self._res = res
+        self._budget = budget
+        self._max_batch = max_batch
+        self._steps = steps
+
+    def _time(self, function, *args) -> float:
+        """
+        Returns the seconds per call of a function after a first call to warm up.
+        """
+        function(*args)
+        start = perf_counter()
+        for _ in range(self._steps):
+            function(*args)
+        return max(perf_counter() - start, 1e-9) / self._steps
+
+    def run(self) -> ModelSettings:
+        """
+        Returns the settings with the fastest batch size, along with every batch size that was tried.
+        """
+        kmodel = self._architecture.compile(self._res, self._classes)
+        probes = list()
+        batch_size = 1
+        try:
+            while batch_size <= self._max_batch:
+                estimate = estimate_bytes(kmodel, batch_size)
+                if estimate > self._budget:
+                    break
+                x = zeros(self._res.array_hwc(batch_size), 'float32')
+                y = zeros((batch_size,) + tuple(kmodel.output_shape[1:]), 'float32')
+                try:
+                    train = self._time(kmodel.train_on_batch, x, y)
+                    predict = self._time(kmodel.predict_on_batch, x)
+                except tf.errors.ResourceExhaustedError:
+                    print('TUNING: batch size %i ran out of memory' % batch_size)
+                    break
+                probe = {
+                    'batch_size': batch_size,
+                    'bytes': estimate,
+                    'train': batch_size / train,
+                    'predict': batch_size / predict,
+                }
+                print('TUNING: batch size %i, %.1f MiB, train %.1f images/s, predict %.1f images/s' % (
+                    batch_size,
+                    estimate / 2 ** 20,
+                    probe['train'],
+                    probe['predict'],
+                ))
+                probes.append(probe)
+                batch_size *= 2
+        finally:
+            del kmodel
+            clear_session()
+        if len(probes) == 0:
+            raise RuntimeError('No batch size fits in %i bytes' % self._budget)
+        best = max(probes, key=lambda p: (p['train'], p['batch_size']))
+        return ModelSettings(self._res, best['batch_size'], probes)
@@ -1,3 +1,4 @@
+import argparse
 import json
 import os.path
 from copy import deepcopy
@@ -8,13 +9,16 @@ import flask
 
 import aaa
 import addon
+from cluster.matrixstore import SimilarityMatrixStore
 from core.cluster import (ClusterRegistry, ClusterRegistryNameError,
                           ClusterResults, ClusterStrategy)
+from core.fingerprint import ALGORITHMS, use_algorithm
 from core.jl import ImageDirectory, function_signature
 from core.kerashelper import TrainingStatus
-from core.model import (BadModelSettings, ModelSplit, ModelStateMissingError,
+from core.model import (BadModelSettings, ModelStateMissingError,
                         TrainingIncompleteException)
 from core.modelbuilder import ModelBuilder
+from core.modelregistry import ModelRegistry, ResidentModel
 from core.typing2 import Url
 
 
@@ -97,7 +101,7 @@ def Evaluation(model, status, training=None, validation=None, test=None):
     }
 
 
-def main(directory: Url, algorithm: ClusterStrategy, algorithm_args: Dict[str, Any], algorithm2: ModelSplit) -> List[List[Dict[str, Any]]]:
+def main(directory: Url, algorithm: ClusterStrategy, algorithm_args: Dict[str, Any], algorithm2: ResidentModel) -> List[List[Dict[str, Any]]]:
     """
     Does all the work.
     """
@@ -112,7 +116,11 @@ def main(directory: Url, algorithm: ClusterStrategy, algorithm_args: Dict[str, A
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fingerprint', choices=ALGORITHMS, default='md5', help='hash of the image contents that keys the caches')
+    use_algorithm(parser.parse_args().fingerprint)
     app = flask.Flask(__name__)
+    registry = ModelRegistry()
 
     @app.route('/run', methods=['POST'])
     def run():
@@ -140,8 +148,18 @@ if __name__ == '__main__':
                 settings.epochs,
                 settings.patience,
             )
-            split = model.split(settings.split)
-            results = main(directory, cluster, settings.clusterArgs, split)
+            key = (
+                settings.architecture,
+                settings.dataset,
+                settings.loss,
+                settings.optimizer,
+                settings.metrics,
+                settings.epochs,
+                settings.patience,
+                settings.split,
+            )
+            with registry.use(key, model.split(settings.split)) as resident:
+                results = main(directory, cluster, settings.clusterArgs, resident)
             results = flask.jsonify(results)
             return results
         except TrainingIncompleteException:
@@ -283,6 +301,57 @@ if __name__ == '__main__':
             response.status = 'Error: Unknown'
             return response
 
+    @app.route('/similarities', methods=['GET'])
+    def similarities():
+        results = list()
+        for store in SimilarityMatrixStore.all():
+            meta = store.meta()
+            results.append({
+                'key': store.key,
+                'name': meta['name'],
+                'shape': meta['shape'],
+                'format': meta['format'],
+            })
+        return flask.jsonify(results)
+
+    @app.route('/similarity', methods=['POST'])
+    def similarity():
+        try:
+            if not flask.request.is_json:
+                response = flask.Response()
+                response.status_code = 400
+                response.status = 'Error: Not JSON'
+                return response
+            settings = flask.request.get_json()
+            key = settings.get('key')
+            # The key becomes a path, so only keys of saved matrices are accepted.
+            if not SimilarityMatrixStore.is_key(key) or key not in [s.key for s in SimilarityMatrixStore.all()]:
+                response = flask.Response()
+                response.status_code = 400
+                response.status = 'Error: Unknown similarity matrix'
+                return response
+            store = SimilarityMatrixStore(key)
+            meta = store.meta()
+            # Rows are sent a page at a time, since a whole matrix can be larger than the memory of the server.
+            start = min(max(0, int(settings.get('start', 0))), meta['shape'][0])
+            stop = int(settings.get('stop', start + SimilarityMatrixStore.PAGE))
+            stop = max(start, min(stop, start + SimilarityMatrixStore.PAGE, meta['shape'][0]))
+            rows = store.rows(start, stop)
+            if meta['format'] == 'sparse':
+                rows = rows.toarray()
+            return flask.jsonify({
+                'images': meta['images'],
+                'start': start,
+                'stop': stop,
+                'rows': rows.tolist(),
+            })
+        except:
+            print_exc()
+            response = flask.Response()
+            response.status_code = 500
+            response.status = 'Error: Unknown'
+            return response
+
     @app.route('/evaluate', methods=['POST'])
     def evaluate():
         if not flask.request.is_json: